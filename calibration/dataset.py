@@ -54,6 +54,10 @@ class FourDVarNetCalDataModule(FourDVarNetDataModule):
         self.obs_target_var = obs_target_var
         self.item_prepro = item_prepro
 
+    def train_split_kwargs(self):
+        # the train datasets are padded and built with the default resolution
+        return dict(aug_train_data=False, use_auto_padding=self.use_auto_padding, resolution=1/20, resize_factor=1)
+
     def setup(self, stage=None):
         self.train_ds, self.val_ds, self.test_ds = [
             ConcatDataset(
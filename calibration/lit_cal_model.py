@@ -195,26 +195,29 @@ class LitCalModel(lit_model_augstate.LitModelAugstate):
             self.log(f'{log_pref}_mse_swath', metrics[-1]['mseSwath'] / self.var_Tr, on_step=False, on_epoch=True, prog_bar=True)
             self.log(f'{log_pref}_mseG_swath', metrics[-1]['mseGradSwath'] / metrics[-1]['meanGrad'], on_step=False, on_epoch=True, prog_bar=True)
 
-        return {'gt'    : (targets_GT.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'oi'    : (targets_OI.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'obs_gt'    : (obs_target_item.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'obs_inp'    : (inputs_obs.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'obs_pred'    : (out_pred.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'pred' : (out.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr}
+        # the predictions are not stitched: full patches
+        outputs = self.pack_diag_outputs({'gt'    : targets_GT,
+                'oi'    : targets_OI,
+                'obs_gt'    : obs_target_item,
+                'obs_inp'    : inputs_obs,
+                'obs_pred'    : out_pred,
+                'pred' : out}, crop=log_pref is not None)
+        if log_pref is None:
+            return outputs
+        return self.stream_diag_outputs(batch_idx, outputs)
 
     def diag_epoch_end(self, outputs, log_pref='test'):
-        full_outputs = self.gather_outputs(outputs, log_pref=log_pref)
-
-        if log_pref == 'test':
-            diag_ds = self.trainer.test_dataloaders[0].dataset.datasets[0]
-        elif log_pref == 'val':
-            diag_ds = self.trainer.val_dataloaders[0].dataset.datasets[0]
-        else:
-            raise Exception('unknown phase')
-        self.test_xr_ds = self.build_test_xr_ds(full_outputs, diag_ds=diag_ds)
+        test_xr_ds = self.get_test_xr_ds(outputs, log_pref=log_pref)
+        if test_xr_ds is None:
+            print("full_outputs is None on ", self.global_rank)
+            return
+        self.test_xr_ds = test_xr_ds
+        if not self.diag_metrics:
+            return
         Path(self.logger.log_dir).mkdir(exist_ok=True)
-        path_save1 = self.logger.log_dir + f'/test.nc'
-        self.test_xr_ds.to_netcdf(path_save1)
+        if self.diag_zarr is None or log_pref != 'test':
+            path_save1 = self.logger.log_dir + f'/test.nc'
+            self.test_xr_ds.to_netcdf(path_save1)
         self.x_gt = self.test_xr_ds.gt.data
         self.obs_inp = self.test_xr_ds.obs_inp.data
         self.obs_gt = self.test_xr_ds.obs_gt.data
@@ -373,6 +376,7 @@ class LitCalModel(lit_model_augstate.LitModelAugstate):
             obs = [ obs, sst_gt ]
 
 
+        self.model.first_order = self.first_order_inference and phase != 'train'
         # need to evaluate grad/backward during the evaluation and training phase for phi_r
         with torch.set_grad_enabled(True):
             # with torch.set_grad_enabled(phase == 'train'):
@@ -1,10 +1,30 @@
 import re
+import os
+import json
+import hashlib
+import shutil
+import weakref
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
 import numpy as np
 import pytorch_lightning as pl
 import xarray as xr
+import torch.distributed as dist
 from torch.utils.data import Dataset, ConcatDataset, DataLoader
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler, DistributedSampler
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import contextlib
+from typing import NamedTuple
+import torch
+from torch.utils.data.dataloader import default_collate
+
+CACHE_DIR = Path.home() / '.cache' / '4dvarnet'
+# version of the cached normalization stats, bumped when their computation changes
+NORM_STATS_VERSION = 2
 
 def parse_resolution_to_float(frac):
     """ Matches a string consting of an integer followed by either a divisor
@@ -40,14 +60,386 @@ def find_pad(sl, st, N):
         pad = 0
     return int(pad/2), int(pad-int(pad/2))
 
-def interpolate_na_2D(da, max_value=100.):
-    return (
-            da.where(np.abs(da) < max_value, np.nan)
-            .pipe(lambda da: da)
-            .to_dataframe()
-            .interpolate()
-            .pipe(xr.Dataset.from_dataframe)
+def reflect_index(n, pad):
+    """
+    indices of the original grid of size n read by each point of its
+    reflect padding (as numpy.pad mode 'reflect') by pad=(before, after)
+    """
+    idx = np.arange(-pad[0], n + pad[1])
+    if n == 1:
+        return np.zeros_like(idx)
+    period = 2 * (n - 1)
+    idx = idx % period
+    return np.where(idx >= n, period - idx, idx)
+
+def interpolate_na_flat(arr, chunk_size=2**22):
+    """
+    In place linear interpolation of the NaNs of `arr` along its flattened (C order) axis,
+    processed by chunks of `chunk_size` elements to bound the temporaries.
+    Matches pandas `interpolate()`: leading NaNs are kept, trailing NaNs take the last valid value.
+    """
+    flat = arr.reshape(-1)
+    n = flat.size
+    prev_pos, prev_val = None, None
+    for start in range(0, n, chunk_size):
+        chunk = flat[start:start + chunk_size]
+        valid_pos = np.flatnonzero(~np.isnan(chunk))
+        if valid_pos.size == 0:
+            continue
+
+        # gap between the last valid value of the previous chunks and the first one of this chunk
+        first_pos = start + valid_pos[0]
+        if prev_pos is not None:
+            for gap_start in range(prev_pos + 1, first_pos, chunk_size):
+                gap = np.arange(gap_start, min(gap_start + chunk_size, first_pos))
+                flat[gap] = np.interp(gap, [prev_pos, first_pos], [prev_val, flat[first_pos]])
+
+        # NaNs surrounded by valid values of the chunk
+        inner = slice(valid_pos[0], valid_pos[-1] + 1)
+        nan_pos = np.flatnonzero(np.isnan(chunk[inner])) + valid_pos[0]
+        if nan_pos.size > 0:
+            chunk[nan_pos] = np.interp(nan_pos, valid_pos, chunk[valid_pos])
+        prev_pos, prev_val = start + valid_pos[-1], chunk[valid_pos[-1]]
+
+    if prev_pos is not None:
+        flat[prev_pos + 1:] = prev_val
+    return arr
+
+def interpolate_na_2D(da, max_value=100., chunk_size=2**22):
+    """
+    NaN interpolation of the dataset variables along their flattened axis
+    (in the dims order used by `to_dataframe`) after masking values above `max_value`,
+    equivalent to `.to_dataframe().interpolate()` without building any DataFrame
+    """
+    dims = list(da.dims)
+    da = da.where(np.abs(da) < max_value, np.nan).transpose(*dims)
+    return da.map(
+        lambda v: v.copy(data=interpolate_na_flat(np.array(v.values, order='C'), chunk_size=chunk_size))
+    )
+
+def cache_key(*parts):
+    """
+    Short stable hash of json-able parts (slices and paths are stringified)
+    """
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()[:16]
+
+def file_signature(path):
+    """
+    Identify a data file by absolute path, size and modification time so that
+    cached artefacts are invalidated when the file changes
+    """
+    st = os.stat(path)
+    return str(Path(path).absolute()), st.st_size, int(st.st_mtime)
+
+def materialize_memmap(da, path, chunk_size=50):
+    """
+    Write the (time, lat, lon) DataArray `da` once as a float32 .npy file and
+    reopen it read-only as a np.memmap.
+    Data is written by chunks of `chunk_size` time steps to bound memory.
+    """
+    path = Path(path)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        mm = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=da.shape)
+        for t in range(0, da.shape[0], chunk_size):
+            mm[t:t + chunk_size] = da.isel(time=slice(t, t + chunk_size)).values
+        mm.flush()
+        del mm
+        # atomic so that concurrent processes never read a partial file
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+class SharedArray:
+    """
+    numpy array placed in POSIX shared memory.
+    Pickling only transfers the name of the memory block: unpickled handles (eg in
+    spawned DataLoader workers) attach a read-only view instead of copying the data.
+    The block is unlinked when the creating handle is garbage collected.
+    """
+    def __init__(self, array):
+        self.shape, self.dtype = array.shape, array.dtype
+        self.shm = SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+        self.array.flags.writeable = False
+        weakref.finalize(self, self.shm.unlink)
+
+    def __getstate__(self):
+        return dict(name=self.shm.name, shape=self.shape, dtype=self.dtype)
+
+    def __setstate__(self, state):
+        self.shape, self.dtype = state['shape'], state['dtype']
+        self.shm = SharedMemory(name=state['name'])
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+        self.array.flags.writeable = False
+
+# opened source files shared in the process: {key: [dataset, number of references, raw file handle]}
+_SOURCES = {}
+_SOURCES_LOCK = threading.Lock()
+
+def zarr_store_path(path):
+    """
+    Location of the zarr conversion of a source file (see convert_to_zarr)
+    """
+    return Path(path).with_suffix('.zarr')
+
+def open_source(path, decode=False, dim_range=None):
+    """
+    Open a source file, decode its time and rename its coords to lat/lon.
+    The zarr conversion of the file is used instead when it exists, is up to date
+    and covers dim_range.
+    The opened datasets are shared in the process (keyed by the file signature)
+    so the datasets of the different splits are views of the same file handle,
+    each call takes a reference on the handle that is given back by release_source
+    :return: opened dataset, key of the reference
+    """
+    store = zarr_store_path(path)
+    if Path(path).suffix != '.zarr' and store.exists():
+        _ds, key = open_source(store, decode)
+        if zarr_store_matches(_ds, path, decode, dim_range):
+            return _ds, key
+        release_source(key)
+        print(f'... Ignore outdated zarr store {store}')
+
+    key = (file_signature(path), decode)
+    with _SOURCES_LOCK:
+        if key not in _SOURCES:
+            _ds, raw = _open_source(path, decode)
+            _SOURCES[key] = [_ds, 0, raw]
+        _SOURCES[key][1] += 1
+        return _SOURCES[key][0], key
+
+def coords_only(ds):
+    """
+    Dataset of the coordinates of ds, without reference to its data variables (nor their file)
+    """
+    return ds.drop_vars(list(ds.data_vars))
+
+def release_source(key):
+    """
+    Give back a reference taken by open_source, the file is closed with its last reference
+    """
+    with _SOURCES_LOCK:
+        entry = _SOURCES.get(key)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _SOURCES[key]
+            # the datasets derived from the opened one (decode_cf, rename) do not close the file
+            entry[2].close()
+
+def _open_source(path, decode):
+    """
+    :return: decoded dataset, dataset opened from the file (closing it closes the file)
+    """
+    if Path(path).suffix == '.zarr':
+        # lazily indexed numpy arrays: only the chunks of the sliced patches are read
+        raw = xr.open_zarr(path, chunks=None)
+    else:
+        raw = xr.open_dataset(path)
+    _ds = raw
+    if decode:
+        if str(_ds.time.dtype) == 'float64':
+            _ds.time.attrs["units"] = "seconds since 2012-10-01"
+            _ds = xr.decode_cf(_ds)
+        else:
+            _ds['time'] = pd.to_datetime(_ds.time)
+
+    # rename latitute/longitude to lat/lon for consistency
+    rename_coords = {}
+    if not "lat" in _ds.coords and "latitude" in _ds.coords:
+        rename_coords["latitude"] = "lat"
+    if not "lon" in _ds.coords and "longitude" in _ds.coords:
+        rename_coords["longitude"] = "lon"
+    _ds = _ds.rename(rename_coords)
+    return _ds, raw
+
+def convert_to_zarr(path, decode=False, dim_range=None, chunks=None, margin=0., overwrite=False):
+    """
+    Rewrite a source file to a chunked zarr store next to it (see zarr_store_path),
+    with the time decoded and the coords renamed as in open_source
+    :param dim_range: Optional region to keep {<dim>: slice(<min>, <max>)...}
+    :param chunks: chunk size for each dimension {<dim>: <chunk_size>...}
+    :param margin: extent kept around the lat/lon bounds of dim_range (for the padding)
+    :param overwrite: whether to rewrite an existing store
+    """
+    store = zarr_store_path(path)
+    if store.exists() and not overwrite:
+        print(f'... {store} already exists')
+        return store
+
+    dim_range = dim_range or {}
+    _ds, raw = _open_source(path, decode)
+    _ds = _ds.sel(**{
+        dim: slice(sl.start - margin, sl.stop + margin) if dim in ('lat', 'lon') else sl
+        for dim, sl in dim_range.items()
+    })
+    for v in _ds.variables.values():
+        v.encoding = {}
+    _ds = _ds.chunk({dim: c for dim, c in (chunks or {}).items() if dim in _ds.dims})
+    _ds.attrs.update(
+        source=str(Path(path).absolute()),
+        source_signature=json.dumps(file_signature(path)),
+        decode=int(decode),
+        dim_range=json.dumps({dim: [sl.start, sl.stop] for dim, sl in dim_range.items()}, default=str),
+    )
+
+    tmp = store.with_name(store.name + '.tmp')
+    shutil.rmtree(tmp, ignore_errors=True)
+    print(f'... Convert {path} to {store}')
+    _ds.to_zarr(tmp, mode='w', consolidated=True)
+    shutil.rmtree(store, ignore_errors=True)
+    os.replace(tmp, store)
+    raw.close()
+    return store
+
+def zarr_store_matches(_ds, path, decode, dim_range=None):
+    """
+    Whether the zarr conversion _ds of path is up to date and was cropped around dim_range
+    """
+    if _ds.attrs.get('source_signature') != json.dumps(file_signature(path)):
+        return False
+    if _ds.attrs.get('decode') != int(decode):
+        return False
+    converted = json.loads(_ds.attrs.get('dim_range', '{}'))
+    for dim, sl in (dim_range or {}).items():
+        if dim not in converted:
+            continue
+        cast = pd.Timestamp if dim == 'time' else float
+        lo, hi = converted[dim]
+        if lo is not None and (sl.start is None or cast(sl.start) < cast(lo)):
+            return False
+        if hi is not None and (sl.stop is None or cast(sl.stop) > cast(hi)):
+            return False
+    return True
+
+class SparseCube:
+    """
+    COO representation of a mostly NaN (time, lat, lon) cube:
+    flat indices of the finite values sorted in C order, their values
+    and the offsets of each time step in the indices
+    """
+    def __init__(self, chunks, shape):
+        """
+        :param chunks: iterable of the consecutive (time, lat, lon) blocks of the cube
+            (eg XrDataset.iter_chunks(full=True)), only one block is loaded at a time
+        :param shape: (time, lat, lon) shape of the cube
+        """
+        self.shape = tuple(shape)
+        nt, size = self.shape[0], int(np.prod(self.shape[1:]))
+        idx, val = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.float32)]
+        t = 0
+        for chunk in chunks:
+            block = np.asarray(chunk, dtype=np.float32)
+            nz = np.flatnonzero(~np.isnan(block.reshape(-1)))
+            idx.append(nz + t * size)
+            val.append(block.reshape(-1)[nz])
+            t += block.shape[0]
+        if t != nt:
+            raise ValueError(f'the chunks cover {t} time steps out of {nt}')
+        self.idx = np.concatenate(idx)
+        self.val = np.concatenate(val)
+        self.time_ptr = np.searchsorted(self.idx, np.arange(nt + 1) * size)
+
+    def box(self, sl):
+        """
+        flat indices in the box and values of the observations in the box `sl` (tuple of slices)
+        """
+        (t0, t1, _), (a0, a1, _), (o0, o1, _) = [s.indices(n) for s, n in zip(sl, self.shape)]
+        _, nlat, nlon = self.shape
+        rng = slice(self.time_ptr[t0], self.time_ptr[t1])
+        t, r = np.divmod(self.idx[rng], nlat * nlon)
+        lat, lon = np.divmod(r, nlon)
+        keep = (lat >= a0) & (lat < a1) & (lon >= o0) & (lon < o1)
+        local = ((t[keep] - t0) * (a1 - a0) + lat[keep] - a0) * (o1 - o0) + lon[keep] - o0
+        return local.astype(np.int32), self.val[rng][keep]
+
+    def patch(self, index):
+        """
+        flat indices in the patch and values of the observations of the patch
+        at `index` (see XrDataset.get_array_index)
+        """
+        if all(isinstance(i, slice) for i in index):
+            return self.box(index)
+        # patch in the padding: densify its bounding box in the original grid
+        box = tuple(slice(int(np.min(i)), int(np.max(i)) + 1) for i in index)
+        box_idx, box_val = self.box(box)
+        dense = np.full([s.stop - s.start for s in box], np.nan, dtype=np.float32)
+        dense.reshape(-1)[box_idx] = box_val
+        dense = dense[tuple(i - s.start for i, s in zip(index, box))].reshape(-1)
+        nz = np.flatnonzero(~np.isnan(dense))
+        return nz.astype(np.int32), dense[nz]
+
+
+class SparseObs(NamedTuple):
+    """
+    Observations of a patch (or a batch of patches) of shape `shape`:
+    flat indices of the observed pixels and their values
+    """
+    idx: np.ndarray
+    val: np.ndarray
+    shape: tuple
+
+
+def collate_sparse_obs(items):
+    """
+    collate_fn for the items with SparseObs observations,
+    the indices are offset to index the flattened batch
+    """
+    oi, obs, gt, *sst = zip(*items)
+    size = int(np.prod(obs[0].shape))
+    obs = SparseObs(
+        torch.from_numpy(np.concatenate([o.idx.astype(np.int64) + b * size for b, o in enumerate(obs)])),
+        torch.from_numpy(np.concatenate([o.val for o in obs])),
+        (len(obs),) + tuple(obs[0].shape),
     )
+    return (default_collate(oi), obs, default_collate(gt), *[default_collate(x) for x in sst])
+
+
+def densify_obs(batch):
+    """
+    Replace the SparseObs of a batch by the dense obs mask and obs tensors
+    (as in the batches served without sparse_obs)
+    """
+    if not any(isinstance(x, SparseObs) for x in batch):
+        return batch
+    dense = []
+    for x in batch:
+        if not isinstance(x, SparseObs):
+            dense.append(x)
+            continue
+        mask = torch.zeros(x.shape, dtype=torch.bool, device=x.val.device)
+        obs = torch.zeros(x.shape, dtype=x.val.dtype, device=x.val.device)
+        mask.view(-1)[x.idx] = True
+        obs.view(-1)[x.idx] = x.val
+        dense.extend([mask, obs])
+    return type(batch)(dense)
+
+
+def running_stats(arrays):
+    """
+    Single pass count, mean, std, min and max over an iterable of arrays, NaNs are ignored.
+    Partial moments of each array are merged with the parallel update of Chan et al.
+    """
+    count, mean, m2 = 0, 0., 0.
+    vmin, vmax = np.inf, -np.inf
+    for a in arrays:
+        a = np.asarray(a)
+        a = a[~np.isnan(a)]
+        n = a.size
+        if n == 0:
+            continue
+        a_mean = a.mean(dtype=np.float64)
+        a_m2 = np.sum((a - a_mean)**2, dtype=np.float64)
+        delta = a_mean - mean
+        tot = count + n
+        mean += delta * n / tot
+        m2 += a_m2 + delta**2 * count * n / tot
+        count = tot
+        vmin, vmax = min(vmin, float(a.min())), max(vmax, float(a.max()))
+    return dict(count=count, mean=float(mean), std=float(np.sqrt(m2 / count)), min=vmin, max=vmax)
 
 class XrDataset(Dataset):
     """
@@ -66,6 +458,8 @@ class XrDataset(Dataset):
         compute=False,
         auto_padding=True,
         interp_na=False,
+        backend='xarray',
+        cache_dir=None,
     ):
         """
         :param path: xarray file
@@ -76,50 +470,37 @@ class XrDataset(Dataset):
         :param strides: strides on each dim while scanning the dataset {<dim>: <dim_stride>...}
         :param decode: Whether to decode the time dim xarray (useful for gt dataset)
         :param compute: whether to convert dask arrays to xr.DataArray (caution memory)
+        :param backend: 'xarray' slices the xarray dataset for each item,
+            'memmap' writes the preprocessed (time, lat, lon) cube once to a float32 memmap
+            and serves items as strided views of it
+        :param cache_dir: directory of the memmap files (default CACHE_DIR)
         """
         super().__init__()
+        assert backend in ('xarray', 'memmap'), f'unknown backend {backend}'
         self.return_coords = False
         self.var = var
         self.resolution = resolution
         self.auto_padding = auto_padding
         self.interp_na = interp_na
-        # try/except block for handling both netcdf and zarr files
-        try:
-            _ds = xr.open_dataset(path)
-        except OSError as ex:
-            raise ex
-            _ds = xr.open_zarr(path)
-        if decode:
-            if str(_ds.time.dtype) == 'float64':
-                _ds.time.attrs["units"] = "seconds since 2012-10-01"
-                _ds = xr.decode_cf(_ds)
-            else:
-                _ds['time'] = pd.to_datetime(_ds.time)
-
-        # rename latitute/longitude to lat/lon for consistency
-        rename_coords = {}
-        if not "lat" in _ds.coords and "latitude" in _ds.coords:
-            rename_coords["latitude"] = "lat"
-        if not "lon" in _ds.coords and "longitude" in _ds.coords:
-            rename_coords["longitude"] = "lon"
-        _ds = _ds.rename(rename_coords)
-
-
+        _ds, source_key = open_source(path, decode, dim_range)
+        # the reference on the file is given back by set_data or when the dataset is collected
+        self.release_source = weakref.finalize(self, release_source, source_key)
         self.ds = _ds.sel(**(dim_range or {}))
         if resize_factor!=1:
             self.ds = self.ds.coarsen(lon=resize_factor).mean(skipna=True).coarsen(lat=resize_factor).mean(skipna=True)
             self.resolution = self.resolution*resize_factor
         # reshape
         # dimensions
+        self.index_maps = {}
         if not self.auto_padding:
-            self.original_coords = self.ds.coords
-            self.padded_coords = self.ds.coords
+            self.original_coords = coords_only(self.ds).coords
+            self.padded_coords = self.original_coords
 
         if self.auto_padding:
             # dimensions
             self.Nt, self.Nx, self.Ny = tuple(self.ds.dims[d] for d in ['time', 'lon', 'lat'])
             # store original input coords for later reconstruction in test pipe
-            self.original_coords = self.ds.coords
+            self.original_coords = coords_only(self.ds).coords
 
             # I) first padding x and y inside available DS coords
             pad_x = find_pad(slice_win['lon'], strides['lon'], self.Nx)
@@ -138,37 +519,25 @@ class XrDataset(Dataset):
             # II) second padding x and y using padding
             pad_x = find_pad(slice_win['lon'], strides['lon'], self.Nx)
             pad_y = find_pad(slice_win['lat'], strides['lat'], self.Ny)
-            # pad the dataset
-            dX = [pad_ *self.resolution for pad_ in pad_x]
-            dY = [pad_ *self.resolution for pad_ in pad_y]
-            pad_ = {'lon':(pad_x[0],pad_x[1]),
-                    'lat':(pad_y[0],pad_y[1])}
-
-            self.ds_reflected = self.ds.pad(pad_, mode='reflect')
+            # the dataset is padded virtually: out of range patch indices are
+            # mapped to their reflection in the original grid (see remap)
+            self.pad = {'lon': pad_x, 'lat': pad_y}
+            self.index_maps = {
+                dim: reflect_index(self.ds.dims[dim], pad) for dim, pad in self.pad.items()
+            }
             self.Nx += np.sum(pad_x)
             self.Ny += np.sum(pad_y)
 
-            # compute padded coords end values with linear ramp
-            # and replace reflected ones
-            end_coords = {
-                'lat': (
-                    self.ds.lat.values[0]  - pad_['lat'][0] * self.resolution,
-                    self.ds.lat.values[-1] + pad_['lat'][1] * self.resolution
-                ),
-                'lon': (
-                    self.ds.lon.values[0]  - pad_['lon'][0] * self.resolution,
-                    self.ds.lon.values[-1] + pad_['lon'][1] * self.resolution
-                )
-            }
-            self.padded_coords = {
-                c: self.ds[c].pad(pad_, end_values=end_coords, mode="linear_ramp")
-                for c in end_coords.keys()
-            }
-
-            # re-assign correctly padded coords in place of reflected coords
-            self.ds = self.ds_reflected.assign_coords(
-                lon=self.padded_coords['lon'], lat=self.padded_coords['lat']
-            )
+            # padded coords extend the original ones linearly
+            self.padded_coords = {}
+            for c, (p0, p1) in self.pad.items():
+                v = self.ds[c].values
+                v = np.concatenate([
+                    v[0] - np.arange(p0, 0, -1) * self.resolution,
+                    v,
+                    v[-1] + np.arange(1, p1 + 1) * self.resolution,
+                ])
+                self.padded_coords[c] = xr.DataArray(v, dims=c, coords={c: v}, name=c)
 
             # III) get lon-lat for the final reconstruction
             dX = ((slice_win['lon']-strides['lon'])/2)*self.resolution
@@ -189,13 +558,51 @@ class XrDataset(Dataset):
 
         self.slice_win = slice_win
         self.strides = strides or {}
+        self.padded_sizes = {
+            dim: len(self.index_maps[dim]) if dim in self.index_maps else self.ds.dims[dim]
+            for dim in self.ds[self.var].dims
+        }
         self.ds_size = {
-                dim: max((self.ds.dims[dim] - slice_win[dim]) // self.strides.get(dim, 1) + 1, 0)
+                dim: max((self.padded_sizes[dim] - slice_win[dim]) // self.strides.get(dim, 1) + 1, 0)
                 for dim in slice_win
         }
 
-    def __del__(self):
-        self.ds.close()
+        self.patch_index = None
+        self.data = None
+        self.shared_data = None
+        if backend == 'memmap':
+            key = cache_key(
+                file_signature(path), var, dim_range, resize_factor, resolution,
+                slice_win, strides, decode, auto_padding, interp_na, self.ds[self.var].shape,
+            )
+            # the items are served from the memmap, the file is released
+            self.set_data(materialize_memmap(
+                self.ds[self.var], Path(cache_dir or CACHE_DIR) / f'{Path(path).stem}_{var}_{key}.npy'
+            ))
+
+    def iter_chunks(self, chunk_size=50, full=False):
+        """
+        Iterate over the non-overlapping (time, lat, lon) blocks of the part of the cube
+        covered by the patches, `chunk_size` time steps at a time
+        :param full: iterate over the whole cube (as returned by get_array) instead
+        """
+        covered = {
+            dim: (n - 1) * self.strides.get(dim, 1) + self.slice_win[dim] if n > 0 else 0
+            for dim, n in self.ds_size.items()
+        }
+        if full:
+            covered = {}
+        sl = {d: self.remap(d, slice(0, covered[d])) if d in covered else slice(None) for d in ('time', 'lat', 'lon')}
+        nt = covered.get('time', self.ds.dims['time'])
+        for t in range(0, nt, chunk_size):
+            t_sl = slice(t, min(t + chunk_size, nt))
+            if self.data is not None:
+                chunk = self.data[t_sl]
+                for axis, d in ((1, 'lat'), (2, 'lon')):
+                    chunk = chunk[(slice(None),) * axis + (sl[d],)]
+                yield chunk
+            else:
+                yield self.ds[self.var].isel(time=t_sl, lat=sl['lat'], lon=sl['lon']).data.astype(np.float32)
 
     def __len__(self):
         size = 1
@@ -215,15 +622,137 @@ class XrDataset(Dataset):
         finally:
             self.return_coords = False
 
-    def __getitem__(self, item):
-        sl = {
-            dim: slice(self.strides.get(dim, 1) * idx,
-                       self.strides.get(dim, 1) * idx + self.slice_win[dim])
+    def get_array(self):
+        """
+        Whole (time, lat, lon) float32 cube (loaded in memory unless already materialized),
+        without the virtual padding
+        """
+        if self.data is not None:
+            return self.data
+        return self.ds[self.var].data.astype(np.float32)
+
+    def set_data(self, data, shared_data=None):
+        """
+        Serve the items from `data`, a (time, lat, lon) array aligned with the dataset,
+        and release the file: only the coordinates are kept
+        :param shared_data: (SharedArray, index) such that data is shared_array.array[index],
+            used to pickle the dataset without the data
+        """
+        if len(self.ds.data_vars) > 0:
+            self.ds = coords_only(self.ds).load()
+        if self.release_source is not None:
+            self.release_source()
+        self.data = data
+        self.shared_data = shared_data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the copies (eg in the DataLoader workers) hold no reference on the shared file
+        state['release_source'] = None
+        if state.get('shared_data') is not None:
+            state['data'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_data is not None:
+            shared, idx = self.shared_data
+            self.data = shared.array[idx]
+
+    def get_starts(self, items):
+        """
+        start index of the item(s) along each dimension {<dim>: <start>...}
+        """
+        return {
+            dim: self.strides.get(dim, 1) * idx
             for dim, idx in zip(self.ds_size.keys(),
-                                np.unravel_index(item, tuple(self.ds_size.values())))
+                                np.unravel_index(items, tuple(self.ds_size.values())))
+        }
+
+    def get_patch_index(self):
+        """
+        Patch grid computed once for all the items, without building their coords
+        :return: (len(self), 3) int array of the (time, lat, lon) start of each item in the padded grid,
+            1D coords of the part of the padded grid covered by the patches {<dim>: <values>...}
+        """
+        if self.patch_index is None:
+            starts = self.get_starts(np.arange(len(self)))
+            offsets = np.stack(
+                [np.asarray(starts.get(d, np.zeros(len(self), dtype=int))) for d in ('time', 'lat', 'lon')],
+                axis=1,
+            )
+            covered = {
+                dim: (n - 1) * self.strides.get(dim, 1) + self.slice_win[dim] if n > 0 else 0
+                for dim, n in self.ds_size.items()
+            }
+            coords = {
+                d: np.asarray(self.padded_coords[d] if d in self.index_maps else self.ds[d])[:covered.get(d)]
+                for d in ('time', 'lat', 'lon')
+            }
+            self.patch_index = (offsets, coords)
+        return self.patch_index
+
+    def get_slices(self, item):
+        return {
+            dim: slice(start, start + self.slice_win[dim])
+            for dim, start in self.get_starts(item).items()
         }
+
+    def remap(self, dim, sl):
+        """
+        Map a slice of the padded grid to the original grid:
+        a slice when it is inside the original grid, the reflected indices otherwise
+        """
+        if dim not in self.index_maps or sl == slice(None):
+            return sl
+        idx = self.index_maps[dim][sl]
+        if len(idx) > 0 and idx[-1] - idx[0] == len(idx) - 1:
+            return slice(int(idx[0]), int(idx[-1]) + 1)
+        return idx
+
+    def get_array_slices(self, item):
+        """
+        slices of the item in (time, lat, lon) order for array indexing
+        """
+        sl = self.get_slices(item)
+        return tuple(sl.get(d, slice(None)) for d in ('time', 'lat', 'lon'))
+
+    def get_array_index(self, item):
+        """
+        index of the item in the (time, lat, lon) original array:
+        basic slices for inner patches, open mesh of indices for patches in the padding
+        """
+        sl = self.get_array_slices(item)
+        idx = tuple(self.remap(d, s) for d, s in zip(('time', 'lat', 'lon'), sl))
+        if all(isinstance(i, slice) for i in idx):
+            return idx
+        return np.ix_(*[
+            np.arange(n)[i] if isinstance(i, slice) else i
+            for i, n in zip(idx, (self.ds.dims[d] for d in ('time', 'lat', 'lon')))
+        ])
+
+    def get_source_starts(self, items):
+        """
+        start index of the item(s) in the original grid along each dimension,
+        and whether the items are inner patches (ie contiguous in the original grid)
+        """
+        starts = self.get_starts(items)
+        inner = np.ones(np.shape(items), dtype=bool)
+        for dim, idx in self.index_maps.items():
+            if dim not in starts:
+                continue
+            first = idx[starts[dim]]
+            inner &= idx[starts[dim] + self.slice_win[dim] - 1] - first == self.slice_win[dim] - 1
+            starts[dim] = first
+        return starts, inner
+
+    def __getitem__(self, item):
+        sl = {d: self.remap(d, s) for d, s in self.get_slices(item).items()}
         if self.return_coords:
-            return self.ds.isel(**sl).coords
+            coords = {d: self.padded_coords[d][s] for d, s in self.get_slices(item).items() if d in self.index_maps}
+            return self.ds.isel(**sl).assign_coords(coords).coords
+        if self.data is not None:
+            return self.data[self.get_array_index(item)]
         return self.ds.isel(**sl)[self.var].data.astype(np.float32)
 
 
@@ -257,7 +786,18 @@ class FourDVarNetDataset(Dataset):
         aug_train_data=False,
         compute=False,
         pp='std',
+        backend='xarray',
+        cache_dir=None,
+        fuse_sources=False,
+        sparse_obs=False,
     ):
+        """
+        :param fuse_sources: stack the oi, obs, gt (and sst) cubes in a single aligned
+            (source, time, lat, lon) array so that an item is one slice followed by one
+            vectorized preprocessing pass, the source files are released afterwards
+        :param sparse_obs: keep the observations as a SparseCube and serve them as SparseObs
+            in place of the obs mask and obs (to batch with collate_sparse_obs and densify_obs)
+        """
         super().__init__()
         self.use_auto_padding=use_auto_padding
 
@@ -274,6 +814,8 @@ class FourDVarNetDataset(Dataset):
             decode=gt_decode,
             resize_factor=resize_factor,
             compute=compute,
+            backend=backend,
+            cache_dir=cache_dir,
             auto_padding=use_auto_padding,
             interp_na=True,
         )
@@ -286,6 +828,8 @@ class FourDVarNetDataset(Dataset):
             decode=obs_mask_decode,
             resize_factor=resize_factor,
             compute=compute,
+            backend=backend,
+            cache_dir=cache_dir,
             auto_padding=use_auto_padding,
         )
 
@@ -298,6 +842,8 @@ class FourDVarNetDataset(Dataset):
             decode=oi_decode,
             resize_factor=resize_factor,
             compute=compute,
+            backend=backend,
+            cache_dir=cache_dir,
             auto_padding=use_auto_padding,
             interp_na=True,
         )
@@ -312,6 +858,8 @@ class FourDVarNetDataset(Dataset):
                 decode=sst_decode,
                 resize_factor=resize_factor,
                 compute=compute,
+                backend=backend,
+                cache_dir=cache_dir,
                 auto_padding=use_auto_padding,
                 interp_na=True,
             )
@@ -324,6 +872,64 @@ class FourDVarNetDataset(Dataset):
         self.norm_stats = (0, 1)
         self.norm_stats_sst = (0, 1)
 
+        self.cube = None
+        self.shared_cube = None
+        if fuse_sources:
+            if sparse_obs:
+                raise ValueError('sparse_obs is not supported with fuse_sources')
+            self.fuse_sources()
+
+        self.obs_coo = None
+        if sparse_obs:
+            # built one chunk at a time, the dense cube is never loaded
+            self.obs_coo = SparseCube(
+                self.obs_mask_ds.iter_chunks(full=True),
+                tuple(self.obs_mask_ds.ds.dims[d] for d in ('time', 'lat', 'lon')),
+            )
+            # the dense observations are released
+            self.obs_mask_ds.set_data(None)
+
+    def get_sources(self):
+        sources = [self.oi_ds, self.obs_mask_ds, self.gt_ds]
+        if self.sst_ds is not None:
+            sources.append(self.sst_ds)
+        return sources
+
+    def fuse_sources(self):
+        arrays = [src.get_array() for src in self.get_sources()]
+        shapes = [a.shape for a in arrays]
+        if len(set(shapes)) > 1:
+            raise ValueError(f'Cannot fuse sources with different grids {shapes}')
+        self.cube = np.stack(arrays)
+        # per source datasets become views of the fused cube
+        for i, src in enumerate(self.get_sources()):
+            src.set_data(self.cube[i])
+
+    def share_memory(self):
+        """
+        Move the fused cube to POSIX shared memory,
+        DataLoader workers then read the same pages instead of holding copies
+        """
+        if self.obs_coo is not None:
+            raise ValueError('sparse_obs is not supported with shared_memory')
+        if self.cube is None:
+            self.fuse_sources()
+        self.shared_cube = SharedArray(self.cube)
+        self.cube = self.shared_cube.array
+        for i, src in enumerate(self.get_sources()):
+            src.set_data(self.cube[i], shared_data=(self.shared_cube, i))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get('shared_cube') is not None:
+            state['cube'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_cube is not None:
+            self.cube = self.shared_cube.array
+
     def set_norm_stats(self, stats, stats_sst=None):
         self.norm_stats = stats
         self.norm_stats_sst = stats_sst
@@ -337,7 +943,7 @@ class FourDVarNetDataset(Dataset):
 
     def coordXY(self):
         # return self.gt_ds.lon, self.gt_ds.lat
-        return self.gt_ds.ds.lon.data, self.gt_ds.ds.lat.data
+        return self.gt_ds.padded_coords['lon'].data, self.gt_ds.padded_coords['lat'].data
 
     @contextlib.contextmanager
     def get_coords(self):
@@ -347,20 +953,111 @@ class FourDVarNetDataset(Dataset):
         finally:
             self.return_coords = False
 
+    def get_patch_index(self):
+        """
+        (time, lat, lon) start offsets of the items and 1D coords of their grid (see XrDataset.get_patch_index)
+        """
+        return self.gt_ds.get_patch_index()
+
     def get_pp(self, normstats):
         bias, scale = normstats
         return lambda t: (t-bias)/scale
 
+    def preprocess_fused(self, patch):
+        """
+        Vectorized preprocessing of fused patches of shape (..., source, time, lat, lon)
+        """
+        n_src = patch.shape[-4]
+        bias, scale = self.norm_stats
+        bias_sst, scale_sst = self.norm_stats_sst if n_src == 4 else (0, 1)
+        bias = np.array([bias, bias, bias, bias_sst][:n_src], dtype=patch.dtype)[:, None, None, None]
+        scale = np.array([scale, scale, scale, scale_sst][:n_src], dtype=patch.dtype)[:, None, None, None]
+
+        x = (patch - bias) / scale
+        oi, obs, gt = x[..., 0, :, :, :], x[..., 1, :, :, :], x[..., 2, :, :, :]
+        oi[~(np.abs(patch[..., 0, :, :, :]) < 10)] = np.nan
+
+        obs_mask = ~np.isnan(obs)
+        oi[np.isnan(oi)] = 0.
+        obs[~obs_mask] = 0.
+        if n_src == 3:
+            return oi, obs_mask, obs, gt
+
+        sst = x[..., 3, :, :, :]
+        sst[np.isnan(sst)] = 0.
+        return oi, obs_mask, obs, gt, sst
+
+    def augment_obs(self, patch, obs_patch):
+        """
+        Replace the observations of raw fused patches by the gt sampled with the mask of `obs_patch`
+        """
+        patch = patch.copy()
+        patch[..., 1, :, :, :] = np.where(~np.isnan(obs_patch), patch[..., 2, :, :, :], np.nan)
+        return patch
+
+    def get_perm_items(self, items):
+        length = len(self.obs_mask_ds)
+        pitems = items % length
+        nperm = items // length
+        for k in range(1, int(np.max(nperm, initial=0)) + 1):
+            pitems = np.where(nperm >= k, self.perm[pitems], pitems)
+        return pitems
+
+    def get_fused_item(self, item):
+        length = len(self.obs_mask_ds)
+        patch = self.cube[(slice(None),) + self.gt_ds.get_array_index(item % length)]
+        if item >= length:
+            pitem = self.get_perm_items(item)
+            patch = self.augment_obs(patch, self.cube[(1,) + self.gt_ds.get_array_index(pitem)])
+        return self.preprocess_fused(patch)
+
+    def __getitems__(self, items):
+        """
+        Batched __getitem__: the inner patches are gathered with a single fancy indexing
+        of a sliding window view of the fused cube (the patches in the padding one by one)
+        and preprocessed at once
+        """
+        if self.cube is None:
+            return tuple(np.stack(x) for x in zip(*[self[i] for i in items]))
+
+        items = np.asarray(items)
+        length = len(self.obs_mask_ds)
+        win = tuple(self.gt_ds.slice_win[d] for d in ('time', 'lat', 'lon'))
+        windows = sliding_window_view(self.cube, win, axis=(1, 2, 3))
+
+        def gather(src, _items):
+            starts, inner = self.gt_ds.get_source_starts(_items)
+            if inner.all():
+                return windows[(src, starts['time'], starts['lat'], starts['lon'])]
+            out = np.empty(self.cube[src].shape[:-3] + (len(_items),) + win, dtype=self.cube.dtype)
+            out[..., inner, :, :, :] = windows[(src, starts['time'][inner], starts['lat'][inner], starts['lon'][inner])]
+            for b in np.flatnonzero(~inner):
+                out[..., b, :, :, :] = self.cube[(src,) + self.gt_ds.get_array_index(_items[b])]
+            return out
+
+        # (source, batch, ...) -> (batch, source, ...)
+        patches = np.moveaxis(gather(slice(None), items % length), 0, 1)
+        aug = items >= length
+        if aug.any():
+            patches[aug] = self.augment_obs(patches[aug], gather(1, self.get_perm_items(items[aug])))
+        return self.preprocess_fused(patches)
+
     def __getitem__(self, item):
         if self.return_coords:
             with self.gt_ds.get_coords():
                 return self.gt_ds[item]
+        if self.cube is not None:
+            return self.get_fused_item(item)
         pp = self.get_pp(self.norm_stats)
         length = len(self.obs_mask_ds)
         if item < length:
             _oi_item = self.oi_ds[item]
-            _obs_item = pp(self.obs_mask_ds[item])
             _gt_item = pp(self.gt_ds[item])
+            if self.obs_coo is None:
+                _obs_item = pp(self.obs_mask_ds[item])
+            else:
+                obs_idx, obs_val = self.obs_coo.patch(self.obs_mask_ds.get_array_index(item))
+                obs_val = pp(obs_val)
         else:
             _oi_item = self.oi_ds[item % length]
             _gt_item = pp(self.gt_ds[item % length])
@@ -368,9 +1065,14 @@ class FourDVarNetDataset(Dataset):
             pitem = item % length
             for _ in range(nperm):
                 pitem = self.perm[pitem]
-            _obs_mask_item = self.obs_mask_ds[pitem]
-            obs_mask_item = ~np.isnan(_obs_mask_item)
-            _obs_item = np.where(obs_mask_item, _gt_item, np.full_like(_gt_item,np.nan))
+            if self.obs_coo is None:
+                _obs_mask_item = self.obs_mask_ds[pitem]
+                obs_mask_item = ~np.isnan(_obs_mask_item)
+                _obs_item = np.where(obs_mask_item, _gt_item, np.full_like(_gt_item,np.nan))
+            else:
+                obs_idx, _ = self.obs_coo.patch(self.obs_mask_ds.get_array_index(pitem))
+                obs_val = _gt_item.reshape(-1)[obs_idx]
+                obs_idx, obs_val = obs_idx[~np.isnan(obs_val)], obs_val[~np.isnan(obs_val)]
 
         _oi_item = pp(np.where(
             np.abs(_oi_item) < 10,
@@ -384,17 +1086,72 @@ class FourDVarNetDataset(Dataset):
         oi_item = np.where(~np.isnan(_oi_item), _oi_item, 0.)
         # obs_mask_item = self.obs_mask_ds[item].astype(bool) & ~np.isnan(oi_item) & ~np.isnan(_gt_item)
 
-        obs_mask_item = ~np.isnan(_obs_item)
-        obs_item = np.where(~np.isnan(_obs_item), _obs_item, np.zeros_like(_obs_item))
+        if self.obs_coo is None:
+            obs_mask_item = ~np.isnan(_obs_item)
+            obs_item = np.where(~np.isnan(_obs_item), _obs_item, np.zeros_like(_obs_item))
+            obs = (obs_mask_item, obs_item)
+        else:
+            obs = (SparseObs(obs_idx, obs_val, gt_item.shape),)
 
         if self.sst_ds == None:
-            return oi_item, obs_mask_item, obs_item, gt_item
+            return (oi_item, *obs, gt_item)
         else:
             pp_sst = self.get_pp(self.norm_stats_sst)
             _sst_item = pp_sst(self.sst_ds[item % length])
             sst_item = np.where(~np.isnan(_sst_item), _sst_item, 0.)
 
-            return oi_item, obs_mask_item, obs_item, gt_item, sst_item
+            return (oi_item, *obs, gt_item, sst_item)
+
+class BatchedConcatDataset(ConcatDataset):
+    """
+    ConcatDataset whose items can be lists of indices,
+    each list is fetched with the __getitems__ of the concatenated datasets
+    """
+    def __getitem__(self, idx):
+        if isinstance(idx, (list, tuple, np.ndarray)):
+            return self.__getitems__(idx)
+        return super().__getitem__(idx)
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        ds_idx = np.searchsorted(self.cumulative_sizes, indices, side='right')
+        offsets = np.concatenate([[0], self.cumulative_sizes[:-1]]).astype(int)
+        positions, parts = [], []
+        for i in np.unique(ds_idx):
+            sel = np.flatnonzero(ds_idx == i)
+            positions.append(sel)
+            parts.append(self.datasets[i].__getitems__(indices[sel] - offsets[i]))
+        order = np.argsort(np.concatenate(positions))
+        return tuple(np.concatenate(x)[order] for x in zip(*parts))
+
+
+class LazyBatchSampler(BatchSampler):
+    """
+    BatchSampler of the index lists fetched at once by BatchedConcatDataset, its sampler is chosen when
+    iterated: a DistributedSampler once the trainer has initialized the process group (the dataloaders
+    are built before), a random or sequential sampler otherwise
+    """
+    def __init__(self, ds, batch_size, shuffle=False, drop_last=False):
+        self.ds = ds
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.dist_sampler = None
+
+    @property
+    def sampler(self):
+        if dist.is_available() and dist.is_initialized():
+            if self.dist_sampler is None:
+                self.dist_sampler = DistributedSampler(self.ds, shuffle=self.shuffle)
+            self.dist_sampler.set_epoch(self.epoch)
+            return self.dist_sampler
+        return RandomSampler(self.ds) if self.shuffle else SequentialSampler(self.ds)
+
+    def set_epoch(self, epoch):
+        # called by the trainer at each epoch, reshuffles the distributed sampler
+        self.epoch = epoch
+
 
 class FourDVarNetDataModule(pl.LightningDataModule):
     def __init__(
@@ -423,7 +1180,15 @@ class FourDVarNetDataModule(pl.LightningDataModule):
             dl_kwargs=None,
             compute=False,
             use_auto_padding=False,
-            pp='std'
+            pp='std',
+            backend='xarray',
+            cache_dir=None,
+            norm_stats_cache=True,
+            fuse_sources=False,
+            batched_fetch=False,
+            shared_memory=False,
+            setup_workers=3,
+            sparse_obs=False,
     ):
         super().__init__()
         self.resize_factor = resize_factor
@@ -452,133 +1217,220 @@ class FourDVarNetDataModule(pl.LightningDataModule):
         self.resize_factor = resize_factor
         self.resolution  = parse_resolution_to_float(resolution)
         self.compute = compute
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self.norm_stats_cache = norm_stats_cache
+        self.fuse_sources = fuse_sources
+        self.batched_fetch = batched_fetch
+        if sparse_obs and batched_fetch:
+            raise ValueError('sparse_obs is not supported with batched_fetch')
+        if sparse_obs and shared_memory:
+            raise ValueError('sparse_obs is not supported with shared_memory')
+        self.sparse_obs = sparse_obs
+        self.shared_memory = shared_memory
+        self.setup_workers = setup_workers
         self.use_auto_padding = use_auto_padding
 
         self.train_slices, self.test_slices, self.val_slices = train_slices, test_slices, val_slices
         self.train_ds, self.val_ds, self.test_ds = None, None, None
+        self.block_ds = None
         self.norm_stats = (0, 1)
         self.norm_stats_sst = None
 
 
+    def source_stats(self, ds, source='gt_ds'):
+        return running_stats(
+            chunk for _ds in ds.datasets for chunk in getattr(_ds, source).iter_chunks()
+        )
+
     def mean_stds(self, ds):
-        sum = 0
-        count = 0
-        for gt in [_it for _ds in ds.datasets for _it in _ds.gt_ds]:
-            sum += np.nansum(gt)
-            count += np.sum(~np.isnan(gt))
-        mean = sum / count
-        sum = 0
-        for gt in [_it for _ds in ds.datasets for _it in _ds.gt_ds]:
-            sum += np.nansum((gt - mean)**2)
-        std = (sum / count)**0.5
+        gt_stats = self.source_stats(ds, 'gt_ds')
+        mean, std = gt_stats['mean'], gt_stats['std']
 
         if self.sst_var == None:
             return mean, std
         else:
             print('... Use SST data')
-            mean_sst = float(xr.concat([_ds.sst_ds.ds[_ds.sst_ds.var] for _ds in ds.datasets], dim='time').mean())
-            std_sst = float(xr.concat([_ds.sst_ds.ds[_ds.sst_ds.var] for _ds in ds.datasets], dim='time').std())
-
-            return [mean, std], [mean_sst, std_sst]
+            sst_stats = self.source_stats(ds, 'sst_ds')
+            return [mean, std], [sst_stats['mean'], sst_stats['std']]
 
     def min_max(self, ds):
-        M = -np.inf
-        m = np.inf
-        for gt in [_it for _ds in ds.datasets for _it in _ds.gt_ds]:
-            M =  max(M ,np.nanmax(gt))
-            m =  min(m ,np.nanmin(gt))
+        gt_stats = self.source_stats(ds, 'gt_ds')
+        m, M = gt_stats['min'], gt_stats['max']
         if self.sst_var == None:
             return m, M-m
         else:
             print('... Use SST data')
-            m_sst = float(xr.concat([_ds.sst_ds.ds[_ds.sst_ds.var] for _ds in ds.datasets], dim='time').min())
-            M_sst = float(xr.concat([_ds.sst_ds.ds[_ds.sst_ds.var] for _ds in ds.datasets], dim='time').max())
-
+            sst_stats = self.source_stats(ds, 'sst_ds')
+            m_sst, M_sst = sst_stats['min'], sst_stats['max']
             return [m, M-m], [m_sst, M_sst-m_sst]
 
+    def train_split_kwargs(self):
+        """
+        Options of the train datasets built by setup that change their patches (and the normalization stats)
+        """
+        return dict(
+            aug_train_data=self.aug_train_data, use_auto_padding=False,
+            resolution=self.resolution, resize_factor=self.resize_factor,
+        )
+
+    def norm_stats_cache_path(self):
+        # the stats are computed on the gt (and sst) of the train patches only
+        key = cache_key(
+            NORM_STATS_VERSION,
+            file_signature(self.gt_path), self.gt_var, self.gt_decode,
+            file_signature(self.sst_path) if self.sst_var is not None else None, self.sst_var, self.sst_decode,
+            self.train_slices, self.dim_range, self.slice_win, self.strides,
+            self.train_split_kwargs(), self.pp,
+        )
+        return Path(self.cache_dir or CACHE_DIR) / f'norm_stats_{key}.json'
+
     def compute_norm_stats(self, ds):
+        cache_path = self.norm_stats_cache_path() if self.norm_stats_cache else None
+        if cache_path is not None and cache_path.exists():
+            print(f'... Load normalization stats from {cache_path}')
+            ns = json.loads(cache_path.read_text())
+            return tuple(ns) if self.sst_var is None else ns
+
         if self.pp == 'std':
-            return self.mean_stds(ds)
+            ns = self.mean_stds(ds)
         elif self.pp == 'norm':
-            return self.min_max(ds)
+            ns = self.min_max(ds)
+
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            cache_path.write_text(json.dumps(ns))
+        return ns
 
     def set_norm_stats(self, ds, ns, ns_sst=None):
         for _ds in ds.datasets:
             _ds.set_norm_stats(ns, ns_sst)
 
     def get_domain_bounds(self, ds):
-        min_lon = round(np.min(np.concatenate([_ds.gt_ds.ds['lon'].values for _ds in ds.datasets])), 2)
-        max_lon = round(np.max(np.concatenate([_ds.gt_ds.ds['lon'].values for _ds in ds.datasets])), 2)
-        min_lat = round(np.min(np.concatenate([_ds.gt_ds.ds['lat'].values for _ds in ds.datasets])), 2)
-        max_lat = round(np.max(np.concatenate([_ds.gt_ds.ds['lat'].values for _ds in ds.datasets])), 2)
+        min_lon = round(np.min(np.concatenate([_ds.gt_ds.padded_coords['lon'].values for _ds in ds.datasets])), 2)
+        max_lon = round(np.max(np.concatenate([_ds.gt_ds.padded_coords['lon'].values for _ds in ds.datasets])), 2)
+        min_lat = round(np.min(np.concatenate([_ds.gt_ds.padded_coords['lat'].values for _ds in ds.datasets])), 2)
+        max_lat = round(np.max(np.concatenate([_ds.gt_ds.padded_coords['lat'].values for _ds in ds.datasets])), 2)
         return min_lon, max_lon, min_lat, max_lat
 
+    def grid_ds(self):
+        # the first block gives the test grid when only the test blocks are built (see setup_blocks)
+        ds = self.test_ds if self.test_ds is not None else self.block_ds
+        return ds.datasets[0]
+
     def coordXY(self):
-        return self.test_ds.datasets[0].coordXY()
+        return self.grid_ds().coordXY()
 
     def get_padded_coords(self):
-        return self.test_ds.datasets[0].gt_ds.padded_coords
+        return self.grid_ds().gt_ds.padded_coords
 
     def get_original_coords(self):
-        return self.test_ds.datasets[0].gt_ds.original_coords
+        return self.grid_ds().gt_ds.original_coords
 
     def get_domain_split(self):
-        return self.test_ds.datasets[0].gt_ds.ds_size
+        return self.grid_ds().gt_ds.ds_size
 
-    def setup(self, stage=None):
-        self.train_ds = ConcatDataset(
-            [FourDVarNetDataset(
-                dim_range={**self.dim_range, **{'time': sl}},
-                strides=self.strides,
-                slice_win=self.slice_win,
-                oi_path=self.oi_path,
-                oi_var=self.oi_var,
-                oi_decode=self.oi_decode,
-                obs_mask_path=self.obs_mask_path,
-                obs_mask_var=self.obs_mask_var,
-                obs_mask_decode=self.obs_mask_decode,
-                gt_path=self.gt_path,
-                gt_var=self.gt_var,
-                gt_decode=self.gt_decode,
-                sst_path=self.sst_path,
-                sst_var=self.sst_var,
-                sst_decode=self.sst_decode,
-                resolution=self.resolution,
-                resize_factor=self.resize_factor,
-                aug_train_data=self.aug_train_data,
-                compute=self.compute,
-                pp=self.pp,
-            ) for sl in self.train_slices])
-
-
-        self.val_ds, self.test_ds = [
-            ConcatDataset(
-                [FourDVarNetDataset(
-                    dim_range={**self.dim_range, **{'time': sl}},
-                    strides=self.strides,
-                    slice_win=self.slice_win,
-                    oi_path=self.oi_path,
-                    oi_var=self.oi_var,
-                    oi_decode=self.oi_decode,
-                    obs_mask_path=self.obs_mask_path,
-                    obs_mask_var=self.obs_mask_var,
-                    obs_mask_decode=self.obs_mask_decode,
-                    gt_path=self.gt_path,
-                    gt_var=self.gt_var,
-                    gt_decode=self.gt_decode,
-                    sst_path=self.sst_path,
-                    sst_var=self.sst_var,
-                    sst_decode=self.sst_decode,
-                    resolution=self.resolution,
-                    resize_factor=self.resize_factor,
-                    compute=self.compute,
-                    use_auto_padding=self.use_auto_padding,
-                    pp=self.pp,
-                ) for sl in slices]
-            )
-            for slices in (self.val_slices, self.test_slices)
+    def get_sources(self):
+        sources = [
+            (self.oi_path, self.oi_decode),
+            (self.obs_mask_path, self.obs_mask_decode),
+            (self.gt_path, self.gt_decode),
+        ]
+        if self.sst_var is not None:
+            sources.append((self.sst_path, self.sst_decode))
+        return list(dict.fromkeys(sources))
+
+    def get_cache_key(self, split='test'):
+        """
+        Key of the batches of a split: source files, patch grid, normalization and batch size
+        """
+        ds_kwargs = {
+            k: v for k, v in self.get_ds_kwargs().items()
+            if k not in ('compute', 'backend', 'cache_dir', 'fuse_sources')
+        }
+        return cache_key(
+            [file_signature(path) for path, _ in self.get_sources()], ds_kwargs,
+            self.dim_range, getattr(self, f'{split}_slices'), self.use_auto_padding,
+            self.norm_stats, self.norm_stats_sst, self.dl_kwargs.get('batch_size'),
+        )
+
+    def convert_to_zarr(self, margin=None, overwrite=False):
+        """
+        Rewrite the sources to zarr stores cropped to dim_range and the time span of the splits,
+        with chunks aligned on the patches (slice_win rounded up to a multiple of strides).
+        The datasets read the stores instead of the source files once converted
+        :param margin: extent kept around dim_range (default one patch)
+        :param overwrite: whether to rewrite existing stores
+        """
+        slices = [*self.train_slices, *self.val_slices, *self.test_slices]
+        dim_range = {
+            **self.dim_range,
+            'time': slice(
+                str(min(pd.Timestamp(sl.start) for sl in slices).date()),
+                str(max(pd.Timestamp(sl.stop) for sl in slices).date()),
+            ),
+        }
+        strides = self.strides or {}
+        chunks = {
+            dim: int(np.ceil(win / strides.get(dim, 1)) * strides.get(dim, 1)) * (self.resize_factor if dim != 'time' else 1)
+            for dim, win in self.slice_win.items()
+        }
+        if margin is None:
+            margin = (max(self.slice_win['lat'], self.slice_win['lon']) + 1) * self.resolution * self.resize_factor
+        return [
+            convert_to_zarr(path, decode, dim_range, chunks=chunks, margin=margin, overwrite=overwrite)
+            for path, decode in self.get_sources()
+        ]
+
+    def get_ds_kwargs(self):
+        return dict(
+            strides=self.strides,
+            slice_win=self.slice_win,
+            oi_path=self.oi_path,
+            oi_var=self.oi_var,
+            oi_decode=self.oi_decode,
+            obs_mask_path=self.obs_mask_path,
+            obs_mask_var=self.obs_mask_var,
+            obs_mask_decode=self.obs_mask_decode,
+            gt_path=self.gt_path,
+            gt_var=self.gt_var,
+            gt_decode=self.gt_decode,
+            sst_path=self.sst_path,
+            sst_var=self.sst_var,
+            sst_decode=self.sst_decode,
+            resolution=self.resolution,
+            resize_factor=self.resize_factor,
+            compute=self.compute,
+            backend=self.backend,
+            cache_dir=self.cache_dir,
+            fuse_sources=self.fuse_sources,
+            sparse_obs=self.sparse_obs,
+            pp=self.pp,
+        )
+
+    def build_split(self, slices, **kwargs):
+        """
+        Datasets of the time slices of a split (built in order so that the
+        random permutations of the augmented train data do not depend on the threads)
+        """
+        return [
+            FourDVarNetDataset(dim_range={**self.dim_range, **{'time': sl}}, **self.get_ds_kwargs(), **kwargs)
+            for sl in slices
         ]
 
+    def setup(self, stage=None):
+        t0 = time.time()
+        concat_cls = BatchedConcatDataset if self.batched_fetch else ConcatDataset
+        # the splits share the opened source files (see open_source) and are built concurrently
+        with ThreadPoolExecutor(max_workers=self.setup_workers) as pool:
+            train = pool.submit(self.build_split, self.train_slices, aug_train_data=self.aug_train_data)
+            val, test = [
+                pool.submit(self.build_split, slices, use_auto_padding=self.use_auto_padding)
+                for slices in (self.val_slices, self.test_slices)
+            ]
+            self.train_ds, self.val_ds, self.test_ds = [concat_cls(f.result()) for f in (train, val, test)]
+        print(f'... Datasets built in {time.time() - t0:.1f}s')
+
         if self.sst_var is None:
             self.norm_stats = self.compute_norm_stats(self.train_ds)
             self.set_norm_stats(self.train_ds, self.norm_stats)
@@ -593,14 +1445,85 @@ class FourDVarNetDataModule(pl.LightningDataModule):
         self.bounding_box = self.get_domain_bounds(self.train_ds)
         self.ds_size = self.get_domain_split()
 
+        if self.shared_memory:
+            for ds in (self.train_ds, self.val_ds, self.test_ds):
+                for _ds in ds.datasets:
+                    _ds.share_memory()
+        print(f'... Datamodule setup in {time.time() - t0:.1f}s')
+
+    def get_dataloader(self, ds, shuffle):
+        if not self.batched_fetch:
+            collate_fn = collate_sparse_obs if self.sparse_obs else None
+            return DataLoader(ds, **{**dict(shuffle=shuffle, collate_fn=collate_fn), **self.dl_kwargs})
+
+        # the sampler yields lists of indices fetched at once by BatchedConcatDataset and splits them
+        # between the ranks itself: the trainer must not replace it (replace_sampler_ddp=False)
+        dl_kwargs = {k: v for k, v in self.dl_kwargs.items() if k not in ('batch_size', 'shuffle', 'drop_last')}
+        batch_sampler = LazyBatchSampler(ds, self.dl_kwargs['batch_size'], shuffle, self.dl_kwargs.get('drop_last', False))
+        return DataLoader(ds, sampler=batch_sampler, batch_size=None, **dl_kwargs)
+
+    def setup_norm_stats(self):
+        """
+        Normalization stats without the val and test splits, the train split is only built
+        when the stats are not cached
+        """
+        train_ds = None
+        if not (self.norm_stats_cache and self.norm_stats_cache_path().exists()):
+            concat_cls = BatchedConcatDataset if self.batched_fetch else ConcatDataset
+            train_ds = concat_cls(self.build_split(self.train_slices, aug_train_data=self.aug_train_data))
+
+        if self.sst_var is None:
+            self.norm_stats = self.compute_norm_stats(train_ds)
+        else:
+            self.norm_stats, self.norm_stats_sst = self.compute_norm_stats(train_ds)
+
+    def setup_blocks(self, block_size, dT):
+        """
+        Setup for test_block_dataloaders instead of setup: the normalization stats and the
+        first test block (which gives the test grid), the val and test splits are not built
+        """
+        self.setup_norm_stats()
+        self.block_ds = next(self.test_block_datasets(block_size, dT))[0]
+        self.ds_size = self.get_domain_split()
+
+    def test_block_datasets(self, block_size, dT):
+        """
+        Consecutive time blocks of the test slices, each block is extended by dT - 1 days on both sides
+        so that all the patches overlapping its days are in its dataset
+        :param block_size: number of days of the blocks
+        :param dT: time size of the patches
+        :return: iterator of (dataset of the extended block, slice of the days of the block)
+        """
+        concat_cls = BatchedConcatDataset if self.batched_fetch else ConcatDataset
+        for sl in self.test_slices:
+            days = pd.date_range(sl.start, sl.stop)
+            for start in range(0, len(days), block_size):
+                block = days[start:start + block_size]
+                ext = days[max(start - dT + 1, 0):start + block_size + dT - 1]
+                if len(ext) < dT:
+                    continue
+                ds = concat_cls(self.build_split(
+                    [slice(str(ext[0].date()), str(ext[-1].date()))], use_auto_padding=self.use_auto_padding
+                ))
+                self.set_norm_stats(ds, self.norm_stats, self.norm_stats_sst)
+                yield ds, slice(block[0], block[-1])
+
+    def test_block_dataloaders(self, block_size, dT):
+        """
+        Dataloaders of the test blocks (see test_block_datasets)
+        :return: iterator of (dataloader of the extended block, slice of the days of the block)
+        """
+        for ds, days in self.test_block_datasets(block_size, dT):
+            yield self.get_dataloader(ds, shuffle=False), days
+
     def train_dataloader(self):
-        return DataLoader(self.train_ds, **{**dict(shuffle=True), **self.dl_kwargs})
+        return self.get_dataloader(self.train_ds, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(self.val_ds, **{**dict(shuffle=False), **self.dl_kwargs})
+        return self.get_dataloader(self.val_ds, shuffle=False)
 
     def test_dataloader(self):
-        return DataLoader(self.test_ds, **{**dict(shuffle=False), **self.dl_kwargs})
+        return self.get_dataloader(self.test_ds, shuffle=False)
 
 
 if __name__ == '__main__':
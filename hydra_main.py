@@ -1,4 +1,6 @@
+import hashlib
 import os
+from pathlib import Path
 
 import pytorch_lightning as pl
 import torch
@@ -11,6 +13,7 @@ from hydra.utils import get_class, instantiate, call
 from omegaconf import OmegaConf
 import hydra_config
 import numpy as np
+from dataloading import cache_key
 
 def get_profiler():
     from pytorch_lightning.profiler import PyTorchProfiler
@@ -39,23 +42,37 @@ class FourDVarNetHydraRunner:
         self.logger = logger
         self.dm = dm
         self.lit_cls = lit_mod_cls
+        self.is_setup = False
+        self._dataloaders = None
+
+    @property
+    def dataloaders(self):
+        # the datamodule splits are only built by the entrypoints using them
+        if self._dataloaders is None:
+            self.setup_splits()
+        return self._dataloaders
+
+    def setup_splits(self):
+        """
+        Build the train, val and test splits of the datamodule and their dataloaders
+        """
+        dm = self.dm
         dm.setup()
-        self.dataloaders = {
+        self._dataloaders = {
             'train': dm.train_dataloader(),
             'val': dm.val_dataloader(),
             'test': dm.test_dataloader(),
         }
+        self.setup(dm)
 
+    def setup(self, datamodule):
         test_dates = np.concatenate([ \
                        [str(dt.date()) for dt in \
-                       pd.date_range(dm.test_slices[i].start,dm.test_slices[i].stop)[(self.cfg.dT//2):-(self.cfg.dT//2)]] \
-                      for i in range(len(dm.test_slices))])
+                       pd.date_range(datamodule.test_slices[i].start,datamodule.test_slices[i].stop)[(self.cfg.dT//2):-(self.cfg.dT//2)]] \
+                      for i in range(len(datamodule.test_slices))])
         #print(test_dates)
         self.time = {'time_test' : test_dates}
 
-        self.setup(dm)
-
-    def setup(self, datamodule):
         self.mean_Tr = datamodule.norm_stats[0]
         self.mean_Tt = datamodule.norm_stats[0]
         self.mean_Val = datamodule.norm_stats[0]
@@ -80,6 +97,7 @@ class FourDVarNetHydraRunner:
         self.resolution = datamodule.resolution
         self.original_coords = datamodule.get_original_coords()
         self.padded_coords = datamodule.get_padded_coords()
+        self.is_setup = True
 
     def run(self, ckpt_path=None, dataloader="test", **trainer_kwargs):
         """
@@ -98,6 +116,8 @@ class FourDVarNetHydraRunner:
         :return: lightning module
         """
         print('get_model: ', ckpt_path)
+        if not self.is_setup:
+            self.setup_splits()
         if ckpt_path:
             mod = self.lit_cls.load_from_checkpoint(ckpt_path,
                                                     hparam=self.cfg,
@@ -174,6 +194,11 @@ class FourDVarNetHydraRunner:
         accelerator = "ddp" if (num_gpus * num_nodes) > 1 else None
         trainer_kwargs_final = {**dict(num_nodes=num_nodes, gpus=gpus, logger=self.logger, strategy=accelerator, auto_select_gpus=(num_gpus * num_nodes) > 0,
                              callbacks=[checkpoint_callback, lr_monitor]),  **trainer_kwargs}
+        if getattr(self.dm, 'batched_fetch', False):
+            # the batch samplers of the datamodule split the batches between the ranks themselves
+            if trainer_kwargs_final.get('replace_sampler_ddp', False) and (num_gpus * num_nodes) > 1:
+                raise ValueError('batched_fetch requires replace_sampler_ddp=False in multi-gpu runs')
+            trainer_kwargs_final['replace_sampler_ddp'] = False
         print(trainer_kwargs)
         print(trainer_kwargs_final)
         trainer = pl.Trainer(**trainer_kwargs_final)
@@ -188,16 +213,87 @@ class FourDVarNetHydraRunner:
         :param trainer_kwargs: (Optional)
         """
 
+        mod = _mod or self._get_model(ckpt_path=ckpt_path)
+        if self.cfg.get('test_cache') is not None:
+            mod.test_cache_dir = self.get_test_cache_dir(mod, dataloader)
+
         if _trainer is not None:
             _trainer.test(mod, dataloaders=self.dataloaders[dataloader])
             return
 
-        mod = _mod or self._get_model(ckpt_path=ckpt_path)
-
         trainer = pl.Trainer(num_nodes=1, gpus=1, accelerator=None, **trainer_kwargs)
         trainer.test(mod, dataloaders=self.dataloaders[dataloader])
         return mod
 
+    def get_test_cache_dir(self, mod, dataloader="test"):
+        """
+        Cache directory of the test batches keyed by the model weights, the params and the datamodule
+        :param mod: lightning module
+        :param dataloader: Dataloader on which to run the test
+        """
+        weights = hashlib.sha1()
+        for k, v in sorted(mod.state_dict().items()):
+            weights.update(k.encode())
+            weights.update(v.detach().cpu().numpy().tobytes())
+        key = cache_key(
+            weights.hexdigest(), OmegaConf.to_container(self.cfg, resolve=True),
+            self.dm.get_cache_key(dataloader), dataloader,
+        )
+        return Path(self.cfg.test_cache) / key
+
+    def test_by_blocks(self, ckpt_path=None, block_size=30, path=None, **trainer_kwargs):
+        """
+        Test a model on consecutive time blocks of the test period: each block is reconstructed,
+        appended to a zarr store and its errors are added to streaming scores, so that the memory
+        does not depend on the length of the test period
+        :param ckpt_path: (Optional) Checkpoint to test
+        :param block_size: number of days of the blocks, the PSD scores are averaged over the blocks
+            so they should be longer than the resolved temporal scales
+        :param path: (Optional) zarr store of the reconstruction, {log_dir}/test.zarr by default
+        :param trainer_kwargs: (Optional)
+        """
+        from metrics import StreamingScores
+
+        # only the normalization stats and the blocks are built, not the (full) train, val and test splits
+        self.dm.setup_blocks(block_size, self.cfg.dT)
+        self.setup(self.dm)
+        mod = self._get_model(ckpt_path=ckpt_path)
+        mod.streaming_diag = True
+        mod.diag_zarr = None
+        mod.diag_metrics = False
+        trainer = pl.Trainer(num_nodes=1, gpus=1, accelerator=None, **trainer_kwargs)
+
+        scores = StreamingScores(psd_size=block_size)
+        n_written = 0
+        for dl, days in self.dm.test_block_dataloaders(block_size, self.cfg.dT):
+            trainer.test(mod, dataloaders=dl)
+            block_ds = mod.test_xr_ds.sel(time=days)
+            mod.test_xr_ds = None
+            if path is None:
+                path = Path(trainer.logger.log_dir) / 'test.zarr'
+            block_ds.to_zarr(path, **(dict(mode='w') if n_written == 0 else dict(append_dim='time')))
+            n_written += block_ds.sizes['time']
+            scores.update(block_ds)
+            print(f'... {n_written} days written to {path}')
+
+        md = scores.compute(log_pref='test')
+        mdf = pd.Series(md)
+        metrics_path = Path(trainer.logger.log_dir) / 'metrics'
+        metrics_path.mkdir(parents=True, exist_ok=True)
+        mdf.to_json(metrics_path / 'test_blocks.json')
+        print(mdf.T.to_markdown())
+        trainer.logger.log_metrics(md)
+        mod.latest_metrics.update(md)
+        return mod
+
+    def convert_to_zarr(self, margin=None, overwrite=False):
+        """
+        Convert the datamodule sources to chunked zarr stores used by the next runs
+        :param margin: (Optional) extent kept around the domain
+        :param overwrite: (Optional) rewrite the existing stores
+        """
+        return self.dm.convert_to_zarr(margin=margin, overwrite=overwrite)
+
     def profile(self):
         """
         Run the profiling
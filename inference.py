@@ -0,0 +1,202 @@
+import itertools
+import numpy as np
+import torch
+import xarray as xr
+
+from dataloading import reflect_index
+from reconstruction import DIMS, PatchAccumulator
+
+
+class SlidingWindowPredictor:
+    """
+    Reconstruction of an arbitrary (time, lat, lon) domain by a trained model without datamodule nor trainer:
+    the inputs are tiled in patches of the training size, the tiles are solved by batches and
+    stitched on the fly with the patch weight of the model
+    """
+    def __init__(self, mod, overlap=None, halo=None, max_memory=2**30, tile_memory=None,
+                 norm_stats_sst=(0, 1), device=None):
+        """
+        :param mod: trained LitModelAugstate (eg utils.get_model)
+        :param overlap: Optional overlap of the successive tiles {<dim>: <n>...}, by default the
+            tiles overlap by their zero weight border in lat/lon and by dT - 1 in time
+        :param halo: Optional margin {<dim>: <n>...} added around the domain (by reflection), by default
+            the zero weight border of the tiles so that the whole domain has a positive weight
+        :param max_memory: memory budget (in bytes) of a batch of tiles
+        :param tile_memory: memory (in bytes) used to solve one tile, estimated if None
+        :param norm_stats_sst: (mean, std) of the sst for the models using it
+        :param device: defaults to the device of the model
+        """
+        self.mod = mod.eval()
+        self.device = torch.device(device) if device is not None else mod.patch_weight.device
+        self.mod.to(self.device)
+        self.mod.model.n_grad = self.mod.hparams.n_grad
+        self.norm_stats_sst = norm_stats_sst
+
+        weight = self.mod.patch_weight.detach().cpu().numpy()
+        self.weight = weight
+        self.tile_size = dict(zip(DIMS, weight.shape))
+        box = PatchAccumulator({d: np.arange(n) for d, n in self.tile_size.items()}, weight).box
+        border = {d: max(b.start, self.tile_size[d] - b.stop) for d, b in zip(DIMS, box)}
+
+        overlap = {
+            'time': self.tile_size['time'] - 1,
+            **{d: self.tile_size[d] - (b.stop - b.start) for d, b in zip(DIMS[1:], box[1:])},
+            **(overlap or {}),
+        }
+        self.strides = {d: self.tile_size[d] - overlap[d] for d in DIMS}
+        if min(self.strides.values()) < 1:
+            raise ValueError(f'the overlap {overlap} must be smaller than the tiles {self.tile_size}')
+        self.halo = {**border, **(halo or {})}
+
+        self.tile_memory = tile_memory if tile_memory is not None else self.estimate_tile_memory()
+        self.batch_size = max(1, int(max_memory // self.tile_memory))
+
+    @classmethod
+    def from_checkpoint(cls, xp_cfg, ckpt, add_overrides=None, **kwargs):
+        """
+        Predictor of a checkpoint of an xp config, loaded without building the datasets: the normalization
+        stats are the ones saved in the checkpoint hparams, the sst ones are read from the norm stats cache
+        of the xp datamodule (or given as norm_stats_sst)
+        """
+        import json
+        from hydra.utils import get_class, instantiate
+        import utils
+        cfg = utils.get_cfg(xp_cfg, add_overrides)
+        mod = get_class(cfg.lit_mod_cls).load_from_checkpoint(ckpt, hparam=cfg.params, strict=False)
+        if mod.use_sst and 'norm_stats_sst' not in kwargs:
+            cache_path = instantiate(cfg.datamodule).norm_stats_cache_path()
+            if not cache_path.exists():
+                raise ValueError(f'no cached norm stats {cache_path}, pass norm_stats_sst')
+            kwargs['norm_stats_sst'] = tuple(json.loads(cache_path.read_text())[1])
+        return cls(mod, **kwargs)
+
+    def estimate_tile_memory(self):
+        """
+        Memory used to solve one tile: measured on a gpu, on the cpu roughly the state and the
+        phi and gradient lstm activations kept by the autograd graph of each solver iteration
+        (of a single iteration with first_order_inference)
+        """
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            base = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            shape = (1, *self.weight.shape)
+            self.solve({
+                'oi': np.zeros(shape, dtype=np.float32),
+                'obs': np.zeros(shape, dtype=np.float32),
+                'mask': np.ones(shape, dtype=bool),
+                'sst': np.zeros(shape, dtype=np.float32),
+            })
+            return torch.cuda.max_memory_allocated(self.device) - base
+
+        hp = self.mod.hparams
+        n_pix = self.tile_size['lat'] * self.tile_size['lon']
+        channels = hp.shape_state[0] + getattr(hp, 'DimAE', 0) + 4 * getattr(hp, 'dim_grad_solver', 0)
+        n_iter = 1 if self.mod.first_order_inference else max(1, self.mod.model.n_grad)
+        return 4 * 2 * n_pix * channels * n_iter
+
+    def get_tiling(self, sizes):
+        """
+        :param sizes: sizes of the domain {<dim>: <n>...}
+        :return: (before, after) padding of each dim, start of the tiles in the padded grid of each dim
+        """
+        pads, starts = {}, {}
+        for d, n in sizes.items():
+            size, stride, halo = self.tile_size[d], self.strides[d], self.halo[d]
+            n_tiles = int(np.ceil(max(n + 2 * halo - size, 0) / stride)) + 1
+            pads[d] = (halo, (n_tiles - 1) * stride + size - n - halo)
+            starts[d] = np.arange(n_tiles) * stride
+        return pads, starts
+
+    def preprocess(self, tiles):
+        """
+        Normalization of raw tiles as the FourDVarNetDataset items
+        """
+        mean, std = float(self.mod.mean_Tr), float(np.sqrt(self.mod.var_Tr))
+        oi = np.where(np.abs(tiles['oi']) < 10, tiles['oi'], np.nan)
+        oi = (oi - mean) / std
+        obs = (tiles['obs'] - mean) / std
+        out = {
+            'oi': np.where(np.isnan(oi), 0., oi).astype(np.float32),
+            'mask': ~np.isnan(obs),
+            'obs': np.where(np.isnan(obs), 0., obs).astype(np.float32),
+        }
+        if 'sst' in tiles:
+            sst = (tiles['sst'] - self.norm_stats_sst[0]) / self.norm_stats_sst[1]
+            out['sst'] = np.where(np.isnan(sst), 0., sst).astype(np.float32)
+        return out
+
+    def solve(self, tiles):
+        """
+        :param tiles: normalized {'oi', 'mask', 'obs'[, 'sst']: (batch, time, lat, lon) arrays}
+        :return: (batch, time, lat, lon) denormalized reconstruction, the OI for the tiles without observations
+        """
+        oi, mask, obs = (torch.from_numpy(tiles[k]).to(self.device) for k in ('oi', 'mask', 'obs'))
+        # the gt of the batch is not used by the solver
+        batch = (oi, mask, obs, oi)
+        if self.mod.use_sst:
+            batch = batch + (torch.from_numpy(tiles['sst']).to(self.device),)
+
+        out = oi.clone()
+        has_obs = mask.flatten(1).any(1)
+        if has_obs.any():
+            batch = tuple(x[has_obs] for x in batch)
+            state_init = [None]
+            for _ in range(self.mod.hparams.n_fourdvar_iter):
+                rec, *state = self.mod.reconstruct(batch, phase='test', state_init=state_init)
+                state_init = [None if s is None else s.detach() for s in state]
+            out[has_obs] = rec.detach()
+        return out.cpu().numpy() * np.sqrt(self.mod.var_Tr) + self.mod.mean_Tr
+
+    def iter_tiles(self, inputs, pads, starts):
+        """
+        Raw tiles of the padded inputs in time major order, the time steps of the inputs
+        are read once for all the tiles sharing them
+        :return: iterator of (offsets in the padded grid, {<input>: (time, lat, lon) array})
+        """
+        index_maps = {d: reflect_index(inputs['oi'].sizes[d], pads[d]) for d in DIMS}
+        win = self.tile_size
+        for t in starts['time']:
+            block = {
+                k: np.asarray(v.isel(time=index_maps['time'][t:t + win['time']]).values, dtype=np.float32)
+                for k, v in inputs.items()
+            }
+            for la, lo in itertools.product(starts['lat'], starts['lon']):
+                ix = np.ix_(index_maps['lat'][la:la + win['lat']], index_maps['lon'][lo:lo + win['lon']])
+                yield (t, la, lo), {k: x[:, ix[0], ix[1]] for k, x in block.items()}
+
+    def predict(self, oi, obs, sst=None, **extent):
+        """
+        :param oi: (time, lat, lon) DataArray of the OI
+        :param obs: DataArray of the observations on the grid of the OI (NaN where not observed)
+        :param sst: DataArray of the sst on the grid of the OI for the models using it
+        :param extent: Optional selection of the reconstructed domain {<dim>: slice(<min>, <max>)...}
+        :return: Dataset of the reconstruction 'pred' on the grid of the (selected) OI
+        """
+        inputs = {'oi': oi, 'obs': obs}
+        if self.mod.use_sst:
+            if sst is None:
+                raise ValueError('the model uses the sst')
+            inputs['sst'] = sst
+        inputs = dict(zip(inputs, xr.align(*inputs.values(), join='exact')))
+        inputs = {k: v.sel(**extent).transpose(*DIMS) for k, v in inputs.items()}
+
+        sizes = dict(inputs['oi'].sizes)
+        pads, starts = self.get_tiling(sizes)
+        acc = PatchAccumulator(
+            {d: np.arange(sizes[d] + sum(pads[d])) for d in DIMS}, self.weight, fields=('pred',)
+        )
+        tiles = self.iter_tiles(inputs, pads, starts)
+        while True:
+            chunk = list(itertools.islice(tiles, self.batch_size))
+            if len(chunk) == 0:
+                break
+            offsets, raw = zip(*chunk)
+            batch = self.preprocess({k: np.stack([r[k] for r in raw]) for k in raw[0]})
+            acc.add_batch(offsets, {'pred': self.solve(batch)})
+
+        return (
+            acc.to_xarray()
+            .isel({d: slice(pads[d][0], pads[d][0] + sizes[d]) for d in DIMS})
+            .assign_coords({d: inputs['oi'][d].values for d in DIMS})
+        )
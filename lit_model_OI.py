@@ -61,9 +61,9 @@ class LitModelOI(LitModelAugstate):
             self.log(f'{log_pref}_mse', metrics[-1]["mse"] / self.var_Tt, on_step=False, on_epoch=True, prog_bar=True)
             self.log(f'{log_pref}_mseG', metrics[-1]['mseGrad'] / metrics[-1]['meanGrad'], on_step=False, on_epoch=True, prog_bar=True)
 
-        return {'gt'    : (targets_GT.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'obs_inp'    : (inputs_obs.detach().where(inputs_Mask, torch.full_like(inputs_obs, np.nan)).cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'pred' : (out.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr}
+        return self.stream_diag_outputs(batch_idx, self.pack_diag_outputs({'gt'    : targets_GT,
+                'obs_inp'    : inputs_obs,
+                'pred' : out}, masks={'obs_inp': inputs_Mask}))
 
     def sla_diag(self, t_idx=3, log_pref='test'):
 
@@ -101,21 +101,18 @@ class LitModelOI(LitModelAugstate):
         return md
 
     def diag_epoch_end(self, outputs, log_pref='test'):
-        full_outputs = self.gather_outputs(outputs, log_pref=log_pref)
-        if full_outputs is None:
+        test_xr_ds = self.get_test_xr_ds(outputs, log_pref=log_pref)
+        if test_xr_ds is None:
             print("full_outputs is None on ", self.global_rank)
             return
-        if log_pref == 'test':
-            diag_ds = self.trainer.test_dataloaders[0].dataset.datasets[0]
-        elif log_pref == 'val':
-            diag_ds = self.trainer.val_dataloaders[0].dataset.datasets[0]
-        else:
-            raise Exception('unknown phase')
-        self.test_xr_ds = self.build_test_xr_ds(full_outputs, diag_ds=diag_ds)
+        self.test_xr_ds = test_xr_ds
+        if not self.diag_metrics:
+            return
 
         Path(self.logger.log_dir).mkdir(exist_ok=True)
-        path_save1 = self.logger.log_dir + f'/test.nc'
-        self.test_xr_ds.to_netcdf(path_save1)
+        if self.diag_zarr is None or log_pref != 'test':
+            path_save1 = self.logger.log_dir + f'/test.nc'
+            self.test_xr_ds.to_netcdf(path_save1)
 
         self.x_gt = self.test_xr_ds.gt.data
         self.obs_inp = self.test_xr_ds.obs_inp.data
@@ -168,6 +165,7 @@ class LitModelOI(LitModelAugstate):
         # gradient norm field
         g_targets_GT_x, g_targets_GT_y = self.gradient_img(targets_GT)
 
+        self.model.first_order = self.first_order_inference and phase != 'train'
         # need to evaluate grad/backward during the evaluation and training phase for phi_r
         with torch.set_grad_enabled(True):
             state = torch.autograd.Variable(state, requires_grad=True)
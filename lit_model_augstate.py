@@ -17,6 +17,8 @@ import torch.optim as optim
 from omegaconf import OmegaConf
 from scipy import stats
 import solver as NN_4DVar
+from dataloading import densify_obs
+from reconstruction import BatchCache, PatchAccumulator, ZarrSink, get_patch_indices
 import metrics
 from metrics import save_netcdf, nrmse, nrmse_scores, mse_scores, plot_nrmse, plot_mse, plot_snr, plot_maps, animate_maps, get_psd_score
 from models import Model_H, Model_HwithSST, Phi_r, ModelLR, Gradient_img
@@ -141,6 +143,17 @@ class LitModelAugstate(pl.LightningModule):
         self.use_sst = self.hparams.sst if hasattr(self.hparams, 'sst') else False
         self.aug_state = self.hparams.aug_state if hasattr(self.hparams, 'aug_state') else False
         self.model = self.create_model()
+        # training: solver iterations recomputed in the backward pass by segments of solver_checkpoint iterations
+        self.model.checkpoint_every = self.hparams.solver_checkpoint if hasattr(self.hparams, 'solver_checkpoint') else 0
+        # training gradient of the solver: 'unrolled', 'phantom' (last solver_grad_steps iterations) or 'implicit'
+        # (fixed point of the last iteration, solver_grad_steps Neumann terms), memory independent of n_grad,
+        # the lstm hidden/cell states are constants of the fixed point map (approximate gradient)
+        self.model.grad_mode = self.hparams.solver_grad_mode if hasattr(self.hparams, 'solver_grad_mode') else 'unrolled'
+        self.model.grad_steps = self.hparams.solver_grad_steps if hasattr(self.hparams, 'solver_grad_steps') else 1
+        # first order inference: solver iterations stopped per patch below this relative change of the state
+        self.model.stop_tol = self.hparams.solver_stop_tol if hasattr(self.hparams, 'solver_stop_tol') else None
+        # log the gpu memory kept by the solver per iteration (tr_solver_mem_iter in MB)
+        self.model.track_saved_bytes = self.hparams.log_solver_memory if hasattr(self.hparams, 'log_solver_memory') else False
         self.model_LR = ModelLR()
         self.grad_crop = lambda t: t[...,1:-1, 1:-1]
         self.gradient_img = lambda t: torch.unbind(
@@ -159,6 +172,27 @@ class LitModelAugstate(pl.LightningModule):
         self.automatic_optimization = self.hparams.automatic_optimization if hasattr(self.hparams, 'automatic_optimization') else False
 
         self.median_filter_width = self.hparams.median_filter_width if hasattr(self.hparams, 'median_filter_width') else 1
+        # val/test solver iterations without second order graph (memory independent of n_grad)
+        self.first_order_inference = self.hparams.first_order_inference if hasattr(self.hparams, 'first_order_inference') else False
+
+        # stitch the diagnostic patches in diag_step instead of keeping the outputs until the epoch end
+        self.streaming_diag = self.hparams.streaming_diag if hasattr(self.hparams, 'streaming_diag') else False
+        self.diag_acc = None
+        # write the test reconstruction to {log_dir}/test.zarr (ZarrSink kwargs) instead of test.nc
+        self.diag_zarr = self.hparams.diag_zarr if hasattr(self.hparams, 'diag_zarr') else None
+        self.diag_sink = None
+        # dtype of the diag outputs kept until stitched (eg float16)
+        self.diag_dtype = self.hparams.diag_dtype if hasattr(self.hparams, 'diag_dtype') else 'float32'
+        # directory of the cached test batch outputs (set by the runner), the cached batches are not recomputed
+        self.test_cache_dir = None
+        self.diag_cache = None
+        # compute the metrics of the test reconstruction at the epoch end (unset by the block test driver)
+        self.diag_metrics = True
+        # val/test ensemble of size_ensemble members solved in one batched pass (noise of the stochastic phi_r
+        # and dropout masks drawn per member), the diag outputs are the member mean, std and quantiles
+        self.ensemble_inference = self.hparams.ensemble_inference if hasattr(self.hparams, 'ensemble_inference') else False
+        self.size_ensemble = self.hparams.size_ensemble if hasattr(self.hparams, 'size_ensemble') else 1
+        self.ensemble_quantiles = list(self.hparams.ensemble_quantiles) if hasattr(self.hparams, 'ensemble_quantiles') else [0.05, 0.5, 0.95]
 
     def create_model(self):
         return self.MODELS[self.model_name](self.hparams)
@@ -168,9 +202,14 @@ class LitModelAugstate(pl.LightningModule):
         metrics = []
         state_init = [None]
         out=None
-        for _ in range(self.hparams.n_fourdvar_iter):
+        # with a fixed point solver gradient, only the last outer iteration is backpropagated so that the
+        # memory does not depend on n_fourdvar_iter either (the losses of the previous ones are only logged)
+        keep_graph = lambda it: phase != 'train' or self.model.grad_mode == 'unrolled' or it == self.hparams.n_fourdvar_iter - 1
+        for it in range(self.hparams.n_fourdvar_iter):
             _loss, out, state, _metrics = self.compute_loss(batch, phase=phase, state_init=state_init)
             state_init = [None if s is None else s.detach() for s in state]
+            if _loss is not None and not keep_graph(it):
+                _loss, out = _loss.detach(), out.detach()
             losses.append(_loss)
             metrics.append(_metrics)
         return losses, out, metrics
@@ -245,6 +284,10 @@ class LitModelAugstate(pl.LightningModule):
 
 
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # sparse observations (datamodule sparse_obs) are densified on the device
+        return densify_obs(batch)
+
     def training_step(self, train_batch, batch_idx, optimizer_idx=0):
 
         # compute loss and metrics
@@ -267,6 +310,8 @@ class LitModelAugstate(pl.LightningModule):
         # self.log("tr_min_nobs", train_batch[1].sum(dim=[1,2,3]).min().item(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
         # self.log("tr_n_nobs", train_batch[1].sum().item(), on_step=True, on_epoch=False, prog_bar=True, logger=True)
         self.log("tr_loss", loss, on_step=True, on_epoch=False, prog_bar=True, logger=True)
+        if getattr(self.model, 'saved_bytes', None) is not None:
+            self.log("tr_solver_mem_iter", self.model.saved_bytes / 2**20 / max(1, self.model.n_grad), on_step=True, on_epoch=False, logger=True)
         self.log("tr_mse", metrics[-1]['mse'] / self.var_Tr, on_step=False, on_epoch=True, prog_bar=True)
         self.log("tr_mseG", metrics[-1]['mseGrad'] / metrics[-1]['meanGrad'], on_step=False, on_epoch=True, prog_bar=True)
 
@@ -277,24 +322,175 @@ class LitModelAugstate(pl.LightningModule):
             targets_OI, inputs_Mask, inputs_obs, targets_GT = batch
         else:
             targets_OI, inputs_Mask, inputs_obs, targets_GT, sst_gt = batch
-        losses, out, metrics = self(batch, phase='test')
+        n_members = self.size_ensemble if self.ensemble_inference else 1
+        if n_members > 1:
+            losses, out, metrics = self.ensemble_forward(batch, n_members)
+        else:
+            losses, out, metrics = self(batch, phase='test')
         loss = losses[-1]
         if loss is not None:
             self.log(f'{log_pref}_loss', loss)
             self.log(f'{log_pref}_mse', metrics[-1]["mse"] / self.var_Tt, on_step=False, on_epoch=True, prog_bar=True)
             self.log(f'{log_pref}_mseG', metrics[-1]['mseGrad'] / metrics[-1]['meanGrad'], on_step=False, on_epoch=True, prog_bar=True)
 
-        return {'gt'    : (targets_GT.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'oi'    : (targets_OI.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'obs_inp'    : (inputs_obs.detach().where(inputs_Mask, torch.full_like(inputs_obs, np.nan)).cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr,
-                'pred' : (out.detach().cpu() * np.sqrt(self.var_Tr)) + self.mean_Tr}
+        if n_members == 1:
+            return self.stream_diag_outputs(batch_idx, self.pack_diag_outputs({
+                    'gt'    : targets_GT,
+                    'oi'    : targets_OI,
+                    'obs_inp'    : inputs_obs,
+                    'pred' : out}, masks={'obs_inp': inputs_Mask}))
+
+        # member statistics of the patches, stitched like the other fields
+        box = (slice(None), slice(None)) + self.get_diag_box()
+        out = out.detach()[box].float()
+        # linear interpolation of the sorted members (torch.quantile is limited to 2**24 elements)
+        members = out.sort(dim=0).values
+        pos = torch.tensor(self.ensemble_quantiles, device=out.device) * (n_members - 1)
+        lo = pos.floor().long()
+        frac = (pos - lo).view(-1, *[1] * (members.dim() - 1))
+        quantiles = torch.lerp(members[lo], members[(lo + 1).clamp(max=n_members - 1)], frac)
+        return self.stream_diag_outputs(batch_idx, self.pack_diag_outputs({
+                'gt'    : targets_GT,
+                'oi'    : targets_OI,
+                'obs_inp'    : inputs_obs,
+                'pred' : out.mean(0),
+                'pred_std' : out.std(0),
+                **{f'pred_q{round(100 * q):02d}': x for q, x in zip(self.ensemble_quantiles, quantiles)},
+            }, masks={'obs_inp': inputs_Mask}, crop=('gt', 'oi', 'obs_inp'), scale_only=('pred_std',)))
+
+    def ensemble_forward(self, batch, n_members):
+        """
+        Forward pass of n_members ensemble members folded in the batch dimension (member major): the batch tensors
+        are expanded to the members, the dropout layers are active so that each member draws its own masks
+        :return: losses and metrics averaged over the members, (n_members, batch, ...) outputs
+        """
+        fold = lambda t: t.expand(n_members, *t.shape).reshape(n_members * t.shape[0], *t.shape[1:])
+        dropouts = [m for m in self.model.modules() if isinstance(m, torch.nn.modules.dropout._DropoutNd)]
+        for m in dropouts:
+            m.train()
+        try:
+            losses, out, metrics = self([fold(t) for t in batch], phase='test')
+        finally:
+            for m in dropouts:
+                m.train(self.training)
+        return losses, out.unflatten(0, (n_members, -1)), metrics
+
+    def get_diag_box(self):
+        """
+        (time, lat, lon) slices of the bounding box of the positive patch weight:
+        the only part of the patches used by the stitching
+        """
+        nz = np.nonzero(self.patch_weight.detach().cpu().numpy() > 0)
+        return tuple(slice(int(i.min()), int(i.max()) + 1) for i in nz)
+
+    def pack_diag_outputs(self, fields, masks=None, crop=True, scale_only=()):
+        """
+        Denormalized diag outputs on the cpu: the fields are cropped to the diag box and stacked
+        in a single tensor moved at once, denormalized and masked in place
+        :param fields: {<name>: (batch, time, lat, lon) normalized tensor...}
+        :param masks: Optional {<name>: (batch, time, lat, lon) bool tensor...}, the field is NaN outside its mask
+        :param crop: crop to the diag box (the stitching expects cropped patches), or names of the fields to crop
+            (the other ones are already cropped)
+        :param scale_only: names of the fields denormalized without the mean (eg std)
+        :return: {<name>: (batch, time, lat, lon) tensor...} views of the packed tensor
+        """
+        box = (slice(None),) + (self.get_diag_box() if crop else ())
+        cropped = (lambda k: k in crop) if isinstance(crop, (list, tuple)) else (lambda k: bool(crop))
+        packed = torch.stack([x.detach()[box] if cropped(k) else x.detach() for k, x in fields.items()])
+        packed.mul_(float(np.sqrt(self.var_Tr))).add_(float(self.mean_Tr))
+        for i, k in enumerate(fields):
+            if k in scale_only:
+                packed[i].sub_(float(self.mean_Tr))
+            if masks is not None and k in masks:
+                packed[i].masked_fill_(~masks[k][box].bool(), np.nan)
+        packed = packed.to(getattr(torch, self.diag_dtype)).cpu()
+        return dict(zip(fields, packed.unbind(0)))
+
+    def on_test_epoch_start(self):
+        self.model.iter_counts = None
+        if self.test_cache_dir is not None:
+            self.diag_cache = BatchCache(self.test_cache_dir, self.global_rank, self.trainer.world_size)
+            print(f'... Test batches cached in {self.test_cache_dir}')
+        if self.streaming_diag:
+            self.start_diag_stream(self.trainer.test_dataloaders[0], log_pref='test')
+
+    def on_validation_epoch_start(self):
+        if self.streaming_diag and (self.current_epoch + 1) % self.hparams.val_diag_freq == 0:
+            self.start_diag_stream(self.trainer.val_dataloaders[0])
+
+    def start_diag_stream(self, dl, log_pref=None):
+        """
+        Prepare the accumulation of the diag_step outputs on the grid of the first dataset of `dl`
+        """
+        diag_ds = dl.dataset.datasets[0]
+        self.diag_offsets, coords, weight = self.get_diag_grid(diag_ds)
+        self.diag_acc = PatchAccumulator(coords, weight)
+        self.diag_batch_indices = get_patch_indices(dl)
+
+        # a single process streaming the test patches writes the time steps as they are completed
+        if (log_pref == 'test' and self.diag_zarr is not None and self.streaming_diag
+                and not dist.is_initialized()):
+            idx = np.concatenate(self.diag_batch_indices)
+            idx = idx[(idx >= 0) & (idx < len(self.diag_offsets))]
+            self.diag_sink = self.get_diag_sink(self.diag_acc, time_offsets=self.diag_offsets[idx, 0])
+
+    def get_diag_grid(self, diag_ds):
+        """
+        Offsets of the diag patches cropped to the diag box, 1D coords of their grid and weight of the cropped patches
+        """
+        box = self.get_diag_box()
+        offsets, coords = diag_ds.get_patch_index()
+        offsets = offsets + np.array([b.start for b in box])
+        return offsets, coords, self.patch_weight.detach().cpu().numpy()[box]
+
+    def get_diag_sink(self, acc, time_offsets=None):
+        return ZarrSink(
+            Path(self.logger.log_dir) / 'test.zarr', acc, time_offsets,
+            domain=instantiate(self.test_domain), time=slice(self.hparams.dT // 2, -self.hparams.dT // 2),
+            **self.diag_zarr,
+        )
+
+    def stream_diag_outputs(self, batch_idx, outputs):
+        """
+        In streaming mode, add the outputs of the batch to the diag accumulator and drop them
+        """
+        if self.diag_cache is not None:
+            self.diag_cache.save(batch_idx, outputs)
+        if not self.streaming_diag:
+            return outputs
+        if self.diag_acc is not None:
+            self.accumulate_diag_outputs(batch_idx, outputs)
+        return None
+
+    def accumulate_diag_outputs(self, batch_idx, outputs):
+        idx = self.diag_batch_indices[batch_idx]
+        keep = (idx >= 0) & (idx < len(self.diag_offsets))
+        (self.diag_sink or self.diag_acc).add_batch(
+            self.diag_offsets[idx[keep]], {k: x.numpy()[keep] for k, x in outputs.items()}
+        )
 
     def test_step(self, test_batch, batch_idx):
+        if self.diag_cache is not None:
+            outputs = self.diag_cache.load(batch_idx)
+            if outputs is not None:
+                return self.stream_diag_outputs(batch_idx, outputs)
         return self.diag_step(test_batch, batch_idx, log_pref='test')
 
     def test_epoch_end(self, step_outputs):
+        self.diag_cache = None
+        self.log_solver_iters(log_pref='test')
         return self.diag_epoch_end(step_outputs, log_pref='test')
 
+    def log_solver_iters(self, log_pref='test'):
+        """
+        Histogram of the solver iteration numbers of the patches (adaptive iterations of solver_stop_tol)
+        """
+        counts = getattr(self.model, 'iter_counts', None)
+        if counts is None:
+            return
+        print(pd.Series(counts, name='patches').rename_axis('iterations').to_frame().T.to_markdown())
+        self.log(f'{log_pref}_solver_iters', float((counts * np.arange(len(counts))).sum() / counts.sum()))
+
     def validation_step(self, batch, batch_idx):
         return self.diag_step(batch, batch_idx, log_pref='val')
 
@@ -304,26 +500,16 @@ class LitModelAugstate(pl.LightningModule):
             return self.diag_epoch_end(outputs, log_pref='val')
 
 
-    def gather_outputs(self, outputs, log_pref):
-        data_path = Path(f'{self.logger.log_dir}/{log_pref}_data')
-        data_path.mkdir(exist_ok=True, parents=True)
-        print(len(outputs))
-        torch.save(outputs, data_path / f'{self.global_rank}.t')
-
-        if dist.is_initialized():
-            dist.barrier()
-
-        if self.global_rank == 0:
-            return [torch.load(f) for f in sorted(data_path.glob('*'))]
-
     def build_test_xr_ds(self, outputs, diag_ds):
-
+        """
+        Stitched dataset of the per rank outputs of a whole dataloader (eg trainer.predict),
+        the full patches (eg LitCalModel.predict_step) are cropped to the diag box of the stitching grid
+        """
         outputs_keys = list(outputs[0][0].keys())
-        with diag_ds.get_coords():
-            self.test_patch_coords = [
-               diag_ds[i]
-               for i in range(len(diag_ds))
-            ]
+        offsets, coords, weight = self.get_diag_grid(diag_ds)
+        full_shape = tuple(self.patch_weight.shape)
+        box = self.get_diag_box()
+        crop = lambda x: x[box] if tuple(x.shape) == full_shape else x
 
         def iter_item(outputs):
             n_batch_chunk = len(outputs)
@@ -333,40 +519,46 @@ class LitModelAugstate(pl.LightningModule):
                 for i in range(bs):
                     for bc in range(n_batch_chunk):
                         yield tuple(
-                                [outputs[bc][b][k][i] for k in outputs_keys]
+                                [crop(outputs[bc][b][k][i]) for k in outputs_keys]
                         )
 
-        dses =[
-                xr.Dataset( {
-                    k: (('time', 'lat', 'lon'), x_k) for k, x_k in zip(outputs_keys, xs)
-                }, coords=coords)
-            for  xs, coords
-            in zip(iter_item(outputs), self.test_patch_coords)
-        ]
-
-        fin_ds = xr.merge([xr.zeros_like(ds[['time','lat', 'lon']]) for ds in dses])
-        fin_ds = fin_ds.assign(
-            {'weight': (fin_ds.dims, np.zeros(list(fin_ds.dims.values()))) }
-        )
-        for v in dses[0]:
-            fin_ds = fin_ds.assign(
-                {v: (fin_ds.dims, np.zeros(list(fin_ds.dims.values()))) }
-            )
-
-        for ds in dses:
-            ds_nans = ds.assign(weight=xr.ones_like(ds.gt)).isnull().broadcast_like(fin_ds).fillna(0.)
-            xr_weight = xr.DataArray(self.patch_weight.detach().cpu(), ds.coords, dims=ds.gt.dims)
-            _ds = ds.pipe(lambda dds: dds * xr_weight).assign(weight=xr_weight).broadcast_like(fin_ds).fillna(0.).where(ds_nans==0, np.nan)
-            fin_ds = fin_ds + _ds
+        acc = PatchAccumulator(coords, weight, outputs_keys)
+        for xs, o in zip(iter_item(outputs), offsets):
+            acc.add(o, dict(zip(outputs_keys, xs)))
 
+        return self.crop_test_xr_ds(acc.to_xarray())
 
+    def crop_test_xr_ds(self, ds):
         return (
-            (fin_ds.drop('weight') / fin_ds.weight)
+            ds
             .sel(instantiate(self.test_domain))
             .isel(time=slice(self.hparams.dT //2, -self.hparams.dT //2))
             # .pipe(lambda ds: ds.sel(time=~(np.isnan(ds.gt).all('lat').all('lon'))))
         ).transpose('time', 'lat', 'lon')
 
+    def get_test_xr_ds(self, outputs, log_pref):
+        """
+        Stitched diagnostic dataset on rank 0 (None on the other ranks):
+        each rank stitches its patches (streamed or from the step outputs)
+        and the accumulators are summed on rank 0 with collectives
+        """
+        if self.diag_acc is None:
+            if log_pref == 'test':
+                self.start_diag_stream(self.trainer.test_dataloaders[0])
+            elif log_pref == 'val':
+                self.start_diag_stream(self.trainer.val_dataloaders[0])
+            else:
+                raise Exception('unknown phase')
+            for batch_idx, out in enumerate(outputs):
+                self.accumulate_diag_outputs(batch_idx, out)
+
+        acc, self.diag_acc = self.diag_acc.reduce(dst=0), None
+        sink, self.diag_sink = self.diag_sink, None
+        if acc is None:
+            return None
+        if log_pref == 'test' and self.diag_zarr is not None:
+            (sink or self.get_diag_sink(acc)).flush(final=True)
+        return self.crop_test_xr_ds(acc.to_xarray())
 
     def nrmse_fn(self, pred, ref, gt):
         return (
@@ -471,21 +663,18 @@ class LitModelAugstate(pl.LightningModule):
         return md
 
     def diag_epoch_end(self, outputs, log_pref='test'):
-        full_outputs = self.gather_outputs(outputs, log_pref=log_pref)
-        if full_outputs is None:
+        test_xr_ds = self.get_test_xr_ds(outputs, log_pref=log_pref)
+        if test_xr_ds is None:
             print("full_outputs is None on ", self.global_rank)
             return
-        if log_pref == 'test':
-            diag_ds = self.trainer.test_dataloaders[0].dataset.datasets[0]
-        elif log_pref == 'val':
-            diag_ds = self.trainer.val_dataloaders[0].dataset.datasets[0]
-        else:
-            raise Exception('unknown phase')
-        self.test_xr_ds = self.build_test_xr_ds(full_outputs, diag_ds=diag_ds)
+        self.test_xr_ds = test_xr_ds
+        if not self.diag_metrics:
+            return
 
         Path(self.logger.log_dir).mkdir(exist_ok=True)
-        path_save1 = self.logger.log_dir + f'/test.nc'
-        self.test_xr_ds.to_netcdf(path_save1)
+        if self.diag_zarr is None or log_pref != 'test':
+            path_save1 = self.logger.log_dir + f'/test.nc'
+            self.test_xr_ds.to_netcdf(path_save1)
 
         self.x_gt = self.test_xr_ds.gt.data
         self.obs_inp = self.test_xr_ds.obs_inp.data
@@ -556,30 +745,16 @@ class LitModelAugstate(pl.LightningModule):
 
         return l_ae, l_ae_gt, l_sr, l_lr
 
-    def compute_loss(self, batch, phase, state_init=(None,)):
-
+    def reconstruct(self, batch, phase, state_init=(None,)):
+        """
+        Reconstruction of a normalized batch by the solver (the gt of the batch is not used)
+        :return: reconstruction, output state, hidden, cell, normgrad
+        """
         if not self.use_sst:
             targets_OI, inputs_Mask, inputs_obs, targets_GT = batch
         else:
             targets_OI, inputs_Mask, inputs_obs, targets_GT, sst_gt = batch
 
-        #targets_OI, inputs_Mask, targets_GT = batch
-        # handle patch with no observation
-        if inputs_Mask.sum().item() == 0:
-            return (
-                    None,
-                    torch.zeros_like(targets_GT),
-                    torch.cat((torch.zeros_like(targets_GT),
-                              torch.zeros_like(targets_GT),
-                              torch.zeros_like(targets_GT)), dim=1),
-                    dict([('mse', 0.),
-                        ('mseGrad', 0.),
-                        ('meanGrad', 1.),
-                        ('mseOI', 0.),
-                        ('mseGOI', 0.)])
-                    )
-        targets_GT_wo_nan = targets_GT.where(~targets_GT.isnan(), targets_OI)
-
         state = self.get_init_state(batch, state_init)
 
         #state = torch.cat((targets_OI, inputs_Mask * (targets_GT_wo_nan - targets_OI)), dim=1)
@@ -595,10 +770,7 @@ class LitModelAugstate(pl.LightningModule):
             new_masks = [ new_masks, torch.ones_like(sst_gt) ]
             obs = [ obs, sst_gt ]
 
-        # gradient norm field
-        g_targets_GT_x, g_targets_GT_y = self.gradient_img(targets_GT)
-
-        # need to evaluate grad/backward during the evaluation and training phase for phi_r
+        self.model.first_order = self.first_order_inference and phase != 'train'
         with torch.set_grad_enabled(True):
             state = torch.autograd.Variable(state, requires_grad=True)
             outputs, hidden_new, cell_new, normgrad = self.model(state, obs, new_masks, *state_init[1:])
@@ -617,6 +789,40 @@ class LitModelAugstate(pl.LightningModule):
             if self.median_filter_width > 1:
                 outputs = kornia.filters.median_blur(outputs, (self.median_filter_width, self.median_filter_width))
 
+        return outputs, outputsSLRHR, hidden_new, cell_new, normgrad
+
+    def compute_loss(self, batch, phase, state_init=(None,)):
+
+        if not self.use_sst:
+            targets_OI, inputs_Mask, inputs_obs, targets_GT = batch
+        else:
+            targets_OI, inputs_Mask, inputs_obs, targets_GT, sst_gt = batch
+
+        #targets_OI, inputs_Mask, targets_GT = batch
+        # handle patch with no observation
+        if inputs_Mask.sum().item() == 0:
+            return (
+                    None,
+                    torch.zeros_like(targets_GT),
+                    torch.cat((torch.zeros_like(targets_GT),
+                              torch.zeros_like(targets_GT),
+                              torch.zeros_like(targets_GT)), dim=1),
+                    dict([('mse', 0.),
+                        ('mseGrad', 0.),
+                        ('meanGrad', 1.),
+                        ('mseOI', 0.),
+                        ('mseGOI', 0.)])
+                    )
+        targets_GT_wo_nan = targets_GT.where(~targets_GT.isnan(), targets_OI)
+
+        # gradient norm field
+        g_targets_GT_x, g_targets_GT_y = self.gradient_img(targets_GT)
+
+        # need to evaluate grad/backward during the evaluation and training phase for phi_r
+        with torch.set_grad_enabled(phase == 'train' or not self.first_order_inference):
+            outputs, outputsSLRHR, hidden_new, cell_new, normgrad = self.reconstruct(batch, phase, state_init)
+            outputsSLR = outputsSLRHR[:, 0:self.hparams.dT, :, :]
+
             # reconstruction losses
             # projection losses
 
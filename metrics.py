@@ -719,10 +719,10 @@ def rmse_based_scores(da_rec, da_ref):
     return rmse_t, rmse_xy, np.round(leaderboard_rmse.values, 5), np.round(reconstruction_error_stability_metric, 5)
 
 
-def psd_based_scores(da_rec, da_ref):
-    # boost-swot-psd-score
-    logging.info('     Compute PSD-based scores...')
-
+def psd_spectra(da_rec, da_ref):
+    """
+    Latitude mean of the (time, lon) PSD of the error and of the signal on the positive frequencies
+    """
     # Compute error = SSH_reconstruction - SSH_true
     err = (da_rec - da_ref)
     err = err.chunk({"lat":1, 'time': err['time'].size, 'lon': err['lon'].size})
@@ -741,7 +741,13 @@ def psd_based_scores(da_rec, da_ref):
     # Averaged over latitude
     mean_psd_signal = psd_signal.mean(dim='lat').where((psd_signal.freq_lon > 0.) & (psd_signal.freq_time > 0), drop=True)
     mean_psd_err = psd_err.mean(dim='lat').where((psd_err.freq_lon > 0.) & (psd_err.freq_time > 0), drop=True)
+    return mean_psd_err, mean_psd_signal
+
 
+def psd_scores(mean_psd_err, mean_psd_signal):
+    """
+    PSD based score and shortest spatial and temporal wavelengths resolved (0.5 contour of the score)
+    """
     # return PSD-based score
     psd_based_score = (1.0 - mean_psd_err/mean_psd_signal)
 
@@ -764,6 +770,82 @@ def psd_based_scores(da_rec, da_ref):
     return psd_da.to_dataset(), np.round(shortest_spatial_wavelength_resolved, 3), np.round(shortest_temporal_wavelength_resolved, 3)
 
 
+def psd_based_scores(da_rec, da_ref):
+    # boost-swot-psd-score
+    logging.info('     Compute PSD-based scores...')
+    return psd_scores(*psd_spectra(da_rec, da_ref))
+
+
+class StreamingScores:
+    """
+    Global test scores (nRMSE, MSE, RMSE and PSD based scores) of a reconstruction
+    accumulated over its consecutive time blocks: the error moments are summed over the blocks
+    and the PSD are averaged over the blocks of psd_size days (the edge blocks cropped by the test
+    domain are shorter and only contribute to the error moments)
+    """
+    def __init__(self, psd_size, pred='pred', ref='oi', gt='gt'):
+        """
+        :param psd_size: nominal number of days of the blocks
+        :param pred: reconstruction field of the blocks
+        :param ref: reference reconstruction of the ratios
+        :param gt: ground truth field of the blocks
+        """
+        self.psd_size = psd_size
+        self.pred, self.ref, self.gt = pred, ref, gt
+        # count, sum and sum of squares of the errors and of the gt
+        self.moments = {k: np.zeros(3) for k in (pred, ref, gt)}
+        self.rmse_t = []
+        self.psd_err, self.psd_signal, self.n_psd = 0., 0., 0
+
+    def update(self, ds):
+        """
+        :param ds: (time, lat, lon) Dataset of a block with the pred, ref and gt fields
+        """
+        gt = ds[self.gt]
+        for k, da in ((self.pred, ds[self.pred] - gt), (self.ref, ds[self.ref] - gt), (self.gt, gt)):
+            x = da.values
+            x = x[~np.isnan(x)].astype(np.float64)
+            self.moments[k] += [x.size, x.sum(), (x ** 2).sum()]
+
+        rmse_t, _, _, _ = rmse_based_scores(ds[self.pred], gt)
+        self.rmse_t.append(rmse_t.values)
+
+        if ds.sizes['time'] == self.psd_size:
+            psd_err, psd_signal = psd_spectra(ds[self.pred], gt)
+            self.psd_err = self.psd_err + psd_err
+            self.psd_signal = self.psd_signal + psd_signal
+            self.n_psd += 1
+
+    def compute(self, log_pref='test'):
+        """
+        :return: metrics dict with the keys of the test diagnostics
+        """
+        n_g, s_g, s2_g = self.moments[self.gt]
+        std_g = np.sqrt(s2_g / n_g - (s_g / n_g) ** 2)
+        nrmse, mse = {}, {}
+        for k in (self.pred, self.ref):
+            n, s, s2 = self.moments[k]
+            nrmse[k] = np.sqrt((s2 / n - (s / n) ** 2) / std_g)
+            mse[k] = s2 / n
+
+        n, _, s2 = self.moments[self.pred]
+        mu = 1.0 - np.sqrt(s2 / n) / np.sqrt(s2_g / n_g)
+        sig = np.std(np.concatenate(self.rmse_t))
+        if self.n_psd == 0:
+            raise ValueError(f'no block of {self.psd_size} days for the PSD scores')
+        _, lamb_x, lamb_t = psd_scores(self.psd_err / self.n_psd, self.psd_signal / self.n_psd)
+        return {
+            f'{log_pref}_lambda_x': lamb_x,
+            f'{log_pref}_lambda_t': lamb_t,
+            f'{log_pref}_mu': np.round(mu, 5),
+            f'{log_pref}_sigma': np.round(sig, 5),
+            f'{log_pref}_nrmse_glob': nrmse[self.pred],
+            f'{log_pref}_nrmse_ratio_glob': nrmse[self.pred] / nrmse[self.ref],
+            f'{log_pref}_mse_glob': mse[self.pred],
+            f'{log_pref}_mse_ratio_glob': mse[self.pred] / mse[self.ref],
+        }
+
+
 def plot_psd_score(ds):
     fig, ax = plt.subplots()
     #ax.invert_yaxis()
@@ -0,0 +1,252 @@
+import shutil
+from pathlib import Path
+import numpy as np
+import xarray as xr
+import torch
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+
+DIMS = ('time', 'lat', 'lon')
+
+
+class PatchAccumulator:
+    """
+    Weighted overlap-add of (time, lat, lon) patches into preallocated arrays of a global grid.
+    A field is NaN where a patch with a positive weight is NaN, and where no patch has a positive weight
+    """
+    def __init__(self, coords, weight, fields=()):
+        """
+        :param coords: 1D coordinates of the global grid {<dim>: <values>...}
+        :param weight: (time, lat, lon) weight of the patch pixels
+        :param fields: names of the stitched fields (the other fields are allocated when first added)
+        """
+        self.coords = {d: np.asarray(coords[d]) for d in DIMS}
+        self.shape = tuple(len(c) for c in self.coords.values())
+        self.weight = np.asarray(weight, dtype=np.float64)
+
+        # only the bounding box of the positive weights contributes
+        nz = np.nonzero(self.weight > 0)
+        self.box = tuple(
+            slice(int(i.min()), int(i.max()) + 1) if len(i) else slice(0, 0) for i in nz
+        )
+        self.box_weight = self.weight[self.box]
+        self.box_pos = self.box_weight > 0
+
+        self.weight_sum = np.zeros(self.shape)
+        self.sum, self.nan = {}, {}
+        for k in fields:
+            self.add_field(k)
+
+    @property
+    def fields(self):
+        return list(self.sum.keys())
+
+    def add_field(self, k):
+        self.sum[k] = np.zeros(self.shape)
+        self.nan[k] = np.zeros(self.shape, dtype=bool)
+
+    def add(self, offsets, patch):
+        """
+        :param offsets: (time, lat, lon) offsets of the patch in the global grid
+        :param patch: {<field>: (time, lat, lon) array...}
+        """
+        sl = tuple(
+            slice(o + b.start, o + b.stop) for o, b in zip(offsets, self.box)
+        )
+        self.weight_sum[sl] += self.box_weight
+        for k, x in patch.items():
+            if k not in self.sum:
+                self.add_field(k)
+            x = np.asarray(x, dtype=np.float64)[self.box]
+            nan = np.isnan(x)
+            self.nan[k][sl] |= nan & self.box_pos
+            self.sum[k][sl] += np.where(nan, 0., x) * self.box_weight
+
+    def add_batch(self, offsets, patches):
+        """
+        :param offsets: (batch, 3) offsets of the patches
+        :param patches: {<field>: (batch, time, lat, lon) array...}
+        """
+        for i, o in enumerate(offsets):
+            self.add(o, {k: x[i] for k, x in patches.items()})
+
+    def reduce(self, dst=0):
+        """
+        Sum the accumulators of all the ranks with torch.distributed collectives
+        (on the gpu for nccl, on the cpu for gloo)
+        :param dst: rank receiving the result, all the ranks if None
+        :return: self on the ranks holding the result, None on the others
+        """
+        if not (dist.is_available() and dist.is_initialized()) or dist.get_world_size() == 1:
+            return self
+
+        # ranks that got no patches have not allocated the fields yet
+        all_fields = [None] * dist.get_world_size()
+        dist.all_gather_object(all_fields, self.fields)
+        for k in sorted(set().union(*all_fields)):
+            if k not in self.sum:
+                self.add_field(k)
+
+        device = torch.device('cuda', torch.cuda.current_device()) if dist.get_backend() == 'nccl' else torch.device('cpu')
+        arrays = [
+            (self.weight_sum, dist.ReduceOp.SUM),
+            *[(self.sum[k], dist.ReduceOp.SUM) for k in sorted(self.sum)],
+            *[(self.nan[k], dist.ReduceOp.MAX) for k in sorted(self.nan)],
+        ]
+        for a, op in arrays:
+            t = torch.from_numpy(a.view(np.uint8) if a.dtype == bool else a).to(device)
+            if dst is None:
+                dist.all_reduce(t, op=op)
+            else:
+                dist.reduce(t, dst, op=op)
+            if dst is None or dist.get_rank() == dst:
+                a[...] = t.cpu().numpy().view(a.dtype)
+
+        if dst is None or dist.get_rank() == dst:
+            return self
+
+    def to_xarray(self, time=slice(None)):
+        """
+        :param time: Optional slice of the time steps to return
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return xr.Dataset(
+                {
+                    k: (DIMS, np.where(self.nan[k][time], np.nan, self.sum[k][time] / self.weight_sum[time]))
+                    for k in self.fields
+                },
+                coords={**self.coords, 'time': self.coords['time'][time]},
+            )
+
+
+class ZarrSink:
+    """
+    Write the time steps of a PatchAccumulator to a zarr store as soon as they are final,
+    ie once no remaining patch overlaps them (the patches come in time order)
+    """
+    def __init__(self, path, acc, time_offsets=None, domain=None, time=slice(None),
+                 dtype='float32', compression=None, append=False):
+        """
+        :param path: zarr store
+        :param acc: PatchAccumulator
+        :param time_offsets: time offsets of all the patches that will be added,
+            if None the time steps are only written by flush(final=True)
+        :param domain: Optional lat/lon bounds {<dim>: slice(<min>, <max>)...} of the written grid
+        :param time: slice of the written time steps of the grid
+        :param dtype: dtype of the stored fields (eg float16)
+        :param compression: Blosc kwargs (eg {'cname': 'zstd', 'clevel': 3}), no compression if None
+        :param append: resume an existing store: the time steps already stored are skipped
+        """
+        self.path = Path(path)
+        self.acc = acc
+        self.domain = {d: sl for d, sl in (domain or {}).items() if d in ('lat', 'lon')}
+        self.dtype = dtype
+        self.compression = compression
+
+        nt = acc.shape[0]
+        self.next, self.stop, _ = time.indices(nt)
+        self.track = time_offsets is not None
+        self.remaining = np.zeros(nt, dtype=int)
+        if self.track:
+            self.count_patches(np.asarray(time_offsets), 1)
+
+        self.exists = append and self.path.exists()
+        if self.exists:
+            stored = xr.open_zarr(self.path).time.values
+            self.next = max(self.next, int(np.searchsorted(acc.coords['time'], stored[-1], side='right')))
+        elif self.path.exists():
+            shutil.rmtree(self.path)
+
+    def count_patches(self, time_offsets, n):
+        box = self.acc.box[0]
+        diff = np.zeros(len(self.remaining) + 1, dtype=int)
+        np.add.at(diff, time_offsets + box.start, n)
+        np.add.at(diff, time_offsets + box.stop, -n)
+        self.remaining += np.cumsum(diff)[:-1]
+
+    def add_batch(self, offsets, patches):
+        """
+        Add patches to the accumulator and write the time steps they complete
+        """
+        self.acc.add_batch(offsets, patches)
+        if self.track and len(offsets) > 0:
+            self.count_patches(np.asarray(offsets)[:, 0], -1)
+            self.flush()
+
+    def flush(self, final=False):
+        """
+        Write the final time steps (all the remaining ones if final)
+        """
+        stop = self.next
+        while stop < self.stop and (final or (self.track and self.remaining[stop] == 0)):
+            stop += 1
+        if stop == self.next:
+            return
+        ds = self.acc.to_xarray(time=slice(self.next, stop)).sel(**self.domain)
+        if self.exists:
+            ds.to_zarr(self.path, append_dim='time')
+        else:
+            encoding = {k: {'dtype': self.dtype, 'chunks': (1, *ds[k].shape[1:])} for k in ds.data_vars}
+            if self.compression is not None:
+                from numcodecs import Blosc
+                for enc in encoding.values():
+                    enc['compressor'] = Blosc(**self.compression)
+            ds.to_zarr(self.path, mode='w', encoding=encoding)
+            self.exists = True
+        self.next = stop
+
+
+class BatchCache:
+    """
+    Outputs of the diag batches saved in one file per batch, so that an interrupted run
+    can skip the batches already done
+    """
+    def __init__(self, path, rank=0, world_size=1):
+        """
+        :param path: cache directory
+        :param rank: rank of the process (the batches of the ranks differ)
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.prefix = f'batch_{world_size}_{rank}'
+
+    def batch_path(self, batch_idx):
+        return self.path / f'{self.prefix}_{batch_idx:06d}.pt'
+
+    def load(self, batch_idx):
+        """
+        :return: cached outputs of the batch, None if not done
+        """
+        path = self.batch_path(batch_idx)
+        if path.exists():
+            return torch.load(path)
+
+    def save(self, batch_idx, outputs):
+        """
+        Save the outputs of a batch not cached yet (atomically so that an interrupted write is not reused)
+        """
+        path = self.batch_path(batch_idx)
+        if path.exists():
+            return
+        tmp = path.with_suffix('.tmp')
+        torch.save(outputs, tmp)
+        tmp.replace(path)
+
+
+def get_patch_indices(dl):
+    """
+    Dataset indices of the items of each batch of a non shuffled dataloader,
+    -1 for the items repeated by a DistributedSampler to even out the ranks
+    """
+    sampler = dl.batch_sampler if dl.batch_sampler is not None else dl.sampler
+    batches = [np.asarray(b, dtype=int) for b in sampler]
+    inner = getattr(sampler, 'sampler', None)
+    if isinstance(inner, DistributedSampler) and len(batches) > 0:
+        sizes = np.cumsum([len(b) for b in batches])[:-1]
+        pos = np.arange(sum(len(b) for b in batches)) * inner.num_replicas + inner.rank
+        batches = [
+            np.where(p < len(inner.dataset), b, -1)
+            for b, p in zip(batches, np.split(pos, sizes))
+        ]
+    return batches
+
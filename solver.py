@@ -10,6 +10,7 @@ import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class CorrelateNoise(torch.nn.Module):
@@ -384,6 +385,21 @@ class Solver_Grad_4DVarNN(nn.Module):
         self.model_VarCost = Model_Var_Cost(m_NormObs, m_NormPhi, shape_data, mod_H.dim_obs, mod_H.dim_obs_channel)
 
         self.stochastic = stochastic
+        # inference without backpropagation through the solver: the graph of each iteration is freed
+        self.first_order = False
+        # training: iterations recomputed in the backward pass by segments of checkpoint_every iterations (0: off)
+        self.checkpoint_every = 0
+        # training gradient: 'unrolled' through all the iterations, 'phantom' through the last grad_steps
+        # iterations only, 'implicit' at the fixed point of the last iteration (Neumann series of grad_steps terms)
+        self.grad_mode = 'unrolled'
+        self.grad_steps = 1
+        # first order inference: iterations stopped per sample once the relative change of the state is below stop_tol
+        self.stop_tol = None
+        # histogram of the iteration numbers of the samples with stop_tol (reset by setting None)
+        self.iter_counts = None
+        # measure the gpu memory kept for the backward pass by solve (saved_bytes)
+        self.track_saved_bytes = False
+        self.saved_bytes = None
 
         with torch.no_grad():
             self.n_grad = int(n_iter_grad)
@@ -392,24 +408,133 @@ class Solver_Grad_4DVarNN(nn.Module):
         return self.solve(x, yobs, mask, *internal_state)
 
     def solve(self, x_0, obs, mask, hidden=None, cell=None, normgrad_=0.):
+        if self.track_saved_bytes and x_0.is_cuda:
+            base = torch.cuda.memory_allocated(x_0.device)
+            out = self.solve_iters(x_0, obs, mask, hidden, cell, normgrad_)
+            self.saved_bytes = torch.cuda.memory_allocated(x_0.device) - base
+            return out
+        return self.solve_iters(x_0, obs, mask, hidden, cell, normgrad_)
+
+    def solve_iters(self, x_0, obs, mask, hidden=None, cell=None, normgrad_=0.):
+        if self.first_order and self.stop_tol is not None:
+            return self.solve_adaptive(x_0, obs, mask, hidden, cell, normgrad_)
+        if self.grad_mode != 'unrolled' and self.training and torch.is_grad_enabled() and not self.first_order:
+            return self.solve_fixed_point(x_0, obs, mask, hidden, cell, normgrad_)
+
         x_k = torch.mul(x_0,1.)
         x_k_plus_1 = None
+        # only in training: val/test enable grad for the variational cost but never backpropagate
+        if self.checkpoint_every > 0 and self.training and torch.is_grad_enabled() and not self.first_order:
+            for it in range(0, self.n_grad, self.checkpoint_every):
+                n_iter = min(self.checkpoint_every, self.n_grad - it)
+                x_k_plus_1, hidden, cell, normgrad_ = checkpoint(
+                    self.solver_steps, n_iter, x_k, obs, mask, hidden, cell, normgrad_, use_reentrant=True
+                )
+                x_k = torch.mul(x_k_plus_1,1.)
+            return x_k_plus_1, hidden, cell, normgrad_
+
         for _ in range(self.n_grad):
+            if self.first_order:
+                x_k = x_k.detach().requires_grad_(True)
             x_k_plus_1, hidden, cell, normgrad_ = self.solver_step(x_k, obs, mask,hidden, cell, normgrad_)
 
             x_k = torch.mul(x_k_plus_1,1.)
 
         return x_k_plus_1, hidden, cell, normgrad_
 
-    def solver_step(self, x_k, obs, mask, hidden, cell,normgrad = 0.):
+    def solve_fixed_point(self, x_0, obs, mask, hidden=None, cell=None, normgrad_=0.):
+        """
+        Iterations with a memory independent of n_grad: the first iterations run without graph, the gradient
+        is backpropagated through the last grad_steps iterations ('phantom') or through the last iteration with
+        the implicit gradient of its fixed point, (I - J^T)^-1 approximated by grad_steps Neumann terms ('implicit').
+        The fixed point map is the state update only: the lstm hidden and cell states entering the graph
+        iterations are detached, so J ignores their dependence on the state (and no gradient flows through them)
+        """
+        if self.grad_mode not in ('phantom', 'implicit'):
+            raise ValueError(f'unknown solver grad mode {self.grad_mode}')
+        n_graph = min(self.grad_steps, self.n_grad) if self.grad_mode == 'phantom' else 1
+
+        self.first_order = True
+        try:
+            x_k = x_0
+            for _ in range(self.n_grad - n_graph):
+                x_k = x_k.detach().requires_grad_(True)
+                x_k, hidden, cell, normgrad_ = self.solver_step(x_k, obs, mask, hidden, cell, normgrad_)
+        finally:
+            self.first_order = False
+
+        x_star = x_k.detach().requires_grad_(True)
+        hidden = None if hidden is None else hidden.detach()
+        cell = None if cell is None else cell.detach()
+        x_k = x_star
+        for _ in range(n_graph):
+            x_k, hidden, cell, normgrad_ = self.solver_step(x_k, obs, mask, hidden, cell, normgrad_)
+
+        if self.grad_mode == 'implicit' and x_k.requires_grad:
+            x_next = x_k
+            def neumann(grad):
+                term, out = grad, grad
+                for _ in range(self.grad_steps - 1):
+                    term = torch.autograd.grad(x_next, x_star, term, retain_graph=True)[0]
+                    out = out + term
+                return out
+            x_k.register_hook(neumann)
+        return x_k, hidden, cell, normgrad_
+
+    def solve_adaptive(self, x_0, obs, mask, hidden=None, cell=None, normgrad_=0.):
+        """
+        First order iterations of the samples whose state still changes by more than stop_tol (relative norm),
+        the converged samples are removed from the batch of the next iterations
+        """
+        select = lambda t, idx: [_t[idx] for _t in t] if isinstance(t, (list, tuple)) else t[idx]
+        n_batch = x_0.shape[0]
+        x_k = x_0.detach().clone()
+        hidden = None if hidden is None else hidden.detach().clone()
+        cell = None if cell is None else cell.detach().clone()
+        active = torch.arange(n_batch, device=x_0.device)
+        n_iters = torch.full((n_batch,), self.n_grad, dtype=torch.long)
+        for it in range(self.n_grad):
+            x_a = x_k[active].requires_grad_(True)
+            h_a, c_a = (None, None) if hidden is None else (hidden[active], cell[active])
+            # the variational cost is normalized by the number of samples of the batch
+            x_next, h_a, c_a, normgrad_ = self.solver_step(
+                x_a, select(obs, active), select(mask, active), h_a, c_a, normgrad_, grad_scale=len(active) / n_batch
+            )
+            if hidden is None:
+                hidden, cell = h_a.new_zeros((n_batch, *h_a.shape[1:])), c_a.new_zeros((n_batch, *c_a.shape[1:]))
+            hidden[active], cell[active] = h_a, c_a
+            x_k[active] = x_next
+
+            change = (x_next - x_a.detach()).flatten(1).norm(dim=1) / x_a.detach().flatten(1).norm(dim=1).clamp_min(1e-12)
+            done = (change < self.stop_tol).cpu()
+            n_iters[active.cpu()[done]] = it + 1
+            active = active[~done.to(active.device)]
+            if len(active) == 0:
+                break
+
+        counts = np.bincount(n_iters.numpy(), minlength=self.n_grad + 1)
+        self.iter_counts = counts if self.iter_counts is None or len(self.iter_counts) != len(counts) else self.iter_counts + counts
+        return x_k, hidden, cell, normgrad_
+
+    def solver_steps(self, n_iter, x_k, obs, mask, hidden, cell, normgrad):
+        # the checkpointed segments run under no_grad, the variational cost gradient needs the graph
+        with torch.enable_grad():
+            for _ in range(n_iter):
+                x_k, hidden, cell, normgrad = self.solver_step(x_k, obs, mask, hidden, cell, normgrad)
+        return x_k, hidden, cell, normgrad
+
+    def solver_step(self, x_k, obs, mask, hidden, cell,normgrad = 0., grad_scale=1.):
         _, var_cost_grad= self.var_cost(x_k, obs, mask)
+        if grad_scale != 1.:
+            var_cost_grad = var_cost_grad * grad_scale
         if normgrad == 0. :
             normgrad_= torch.sqrt( torch.mean( var_cost_grad**2 + 0.))
         else:
             normgrad_= normgrad
-        grad, hidden, cell = self.model_Grad(hidden, cell, var_cost_grad, normgrad_)
-        grad *= 1./ self.n_grad
-        x_k_plus_1 = x_k - grad
+        with torch.set_grad_enabled(torch.is_grad_enabled() and not self.first_order):
+            grad, hidden, cell = self.model_Grad(hidden, cell, var_cost_grad, normgrad_)
+            grad *= 1./ self.n_grad
+            x_k_plus_1 = x_k - grad
         return x_k_plus_1, hidden, cell, normgrad_
 
     def var_cost(self , x, yobs, mask):
@@ -418,5 +543,5 @@ class Solver_Grad_4DVarNN(nn.Module):
 
         loss = self.model_VarCost( dx , dy )
 
-        var_cost_grad = torch.autograd.grad(loss, x, create_graph=True)[0]
+        var_cost_grad = torch.autograd.grad(loss, x, create_graph=not self.first_order)[0]
         return loss, var_cost_grad
@@ -0,0 +1,214 @@
+"""
+CPU checks of the dataloading helpers against their previous (materialized) implementations
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+import xarray as xr
+
+import dataloading
+from dataloading import LazyBatchSampler
+
+
+def test_lazy_batch_sampler():
+    ds = list(range(10))
+    batches = list(LazyBatchSampler(ds, 4))
+    assert [list(b) for b in batches] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert len(LazyBatchSampler(ds, 4, drop_last=True)) == 2
+    shuffled = np.concatenate(list(LazyBatchSampler(ds, 3, shuffle=True)))
+    np.testing.assert_array_equal(np.sort(shuffled), ds)
+
+
+def interpolate_na_2D_dataframe(da, max_value=100.):
+    # previous implementation through a DataFrame
+    return (
+            da.where(np.abs(da) < max_value, np.nan)
+            .to_dataframe()
+            .interpolate()
+            .pipe(xr.Dataset.from_dataframe)
+    )
+
+
+def get_nan_array(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(size=shape)
+    flat = arr.reshape(-1)
+    # runs of NaNs of random lengths, some of them longer than the chunks
+    for start, length in zip(rng.integers(0, flat.size, 12), rng.integers(1, 25, 12)):
+        flat[start:start + length] = np.nan
+    flat[:3] = np.nan
+    flat[-4:] = np.nan
+    return arr
+
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 7, 64, 2**22])
+def test_interpolate_na_flat(chunk_size):
+    arr = get_nan_array((6, 5, 8))
+    expected = pd.Series(arr.reshape(-1)).interpolate().values.reshape(arr.shape)
+    out = dataloading.interpolate_na_flat(arr.copy(), chunk_size=chunk_size)
+    np.testing.assert_allclose(out, expected)
+    # leading NaNs are kept
+    assert np.isnan(out.reshape(-1)[:3]).all()
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 2**22])
+def test_interpolate_na_flat_edge_cases(chunk_size):
+    all_nan = np.full(20, np.nan)
+    np.testing.assert_array_equal(np.isnan(dataloading.interpolate_na_flat(all_nan.copy(), chunk_size)), True)
+
+    # a single valid value with NaN runs longer than the chunks on both sides
+    arr = np.full(40, np.nan)
+    arr[17] = 2.
+    expected = pd.Series(arr).interpolate().values
+    np.testing.assert_allclose(dataloading.interpolate_na_flat(arr.copy(), chunk_size), expected)
+
+    # two valid values separated by several NaN only chunks
+    arr[35] = -1.
+    expected = pd.Series(arr).interpolate().values
+    np.testing.assert_allclose(dataloading.interpolate_na_flat(arr.copy(), chunk_size), expected)
+
+
+@pytest.mark.parametrize('chunk_size', [7, 2**22])
+def test_interpolate_na_2D(chunk_size):
+    shape = (4, 6, 9)
+    coords = {'time': pd.date_range('2013-01-01', periods=shape[0]), 'lat': np.arange(shape[1]), 'lon': np.arange(shape[2])}
+    ssh = get_nan_array(shape, seed=1)
+    # all NaN rows (and a whole time step) and values above max_value
+    ssh[1, 2, :] = np.nan
+    ssh[2, :, 4] = np.nan
+    ssh[3] = np.nan
+    ssh[0, 0, 5] = 150.
+    sst = get_nan_array(shape, seed=2)
+    sst[:, 3, :] = np.nan
+    ds = xr.Dataset(
+        {'ssh': (('time', 'lat', 'lon'), ssh), 'sst': (('time', 'lat', 'lon'), sst)}, coords=coords,
+    )
+
+    out = dataloading.interpolate_na_2D(ds, chunk_size=chunk_size)
+    xr.testing.assert_allclose(out, interpolate_na_2D_dataframe(ds))
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 5, 8])
+@pytest.mark.parametrize('pad', [(0, 0), (1, 2), (3, 4), (7, 9), (20, 13)])
+def test_reflect_index(n, pad):
+    np.testing.assert_array_equal(dataloading.reflect_index(n, pad), np.pad(np.arange(n), pad, mode='reflect'))
+
+
+def pad_dataset(ds, pad, resolution):
+    # previous implementation: materialized reflect padding with the coords extended linearly
+    padded = ds.pad(pad, mode='reflect')
+    padded_coords = {
+        c: ds[c].pad(
+            {c: p}, mode='linear_ramp',
+            end_values={c: (ds[c].values[0] - p[0] * resolution, ds[c].values[-1] + p[1] * resolution)},
+        ).values
+        for c, p in pad.items()
+    }
+    return padded, padded_coords
+
+
+@pytest.mark.parametrize('n_lat, n_lon, slice_win, strides', [
+    # odd pads, and pads larger than the data along lat
+    (5, 12, {'time': 2, 'lat': 16, 'lon': 8}, {'time': 1, 'lat': 4, 'lon': 3}),
+    (9, 7, {'time': 3, 'lat': 4, 'lon': 6}, {'time': 1, 'lat': 2, 'lon': 1}),
+])
+def test_virtual_padding(tmp_path, n_lat, n_lon, slice_win, strides):
+    resolution = 0.25
+    rng = np.random.default_rng(0)
+    src = xr.Dataset(
+        {'ssh': (('time', 'lat', 'lon'), rng.normal(size=(5, n_lat, n_lon)))},
+        coords={'time': np.arange(5), 'lat': 40 + np.arange(n_lat) * resolution, 'lon': -60 + np.arange(n_lon) * resolution},
+    )
+    path = tmp_path / 'ssh.nc'
+    src.to_netcdf(path)
+    dim_range = {'time': slice(0, 4), 'lat': slice(40, 50), 'lon': slice(-60, -50)}
+    xds = dataloading.XrDataset(
+        path, 'ssh', slice_win=slice_win, resolution=resolution, dim_range=dim_range, strides=strides,
+    )
+
+    pad = {'lat': dataloading.find_pad(slice_win['lat'], strides['lat'], n_lat),
+           'lon': dataloading.find_pad(slice_win['lon'], strides['lon'], n_lon)}
+    assert xds.pad == pad
+    padded, padded_coords = pad_dataset(src.sel(time=dim_range['time']), pad, resolution)
+    for c in ('lat', 'lon'):
+        np.testing.assert_allclose(xds.padded_coords[c].values, padded_coords[c])
+
+    ref = padded.ssh.transpose('time', 'lat', 'lon').values.astype(np.float32)
+    ds_size = {d: (padded.dims[d] - slice_win[d]) // strides[d] + 1 for d in slice_win}
+    assert xds.ds_size == ds_size
+    assert len(xds) == np.prod(list(ds_size.values()))
+
+    for item in range(len(xds)):
+        sl = xds.get_array_slices(item)
+        np.testing.assert_array_equal(xds[item], ref[sl])
+        with xds.get_coords():
+            coords = xds[item]
+        for c, s in zip(('lat', 'lon'), sl[1:]):
+            np.testing.assert_allclose(coords[c].values, padded_coords[c][s])
+
+    # items served from the materialized cube (get_array_index)
+    xds.set_data(xds.get_array().copy())
+    for item in range(len(xds)):
+        np.testing.assert_array_equal(xds[item], ref[xds.get_array_slices(item)])
+
+
+def write_sources(tmp_path, shape=(6, 9, 10), resolution=0.25):
+    rng = np.random.default_rng(0)
+    coords = {'time': np.arange(shape[0]), 'lat': 40 + np.arange(shape[1]) * resolution,
+              'lon': -60 + np.arange(shape[2]) * resolution}
+    obs = rng.normal(size=shape)
+    obs[rng.random(shape) > 0.1] = np.nan
+    paths = {}
+    for name, data in (('oi', rng.normal(size=shape)), ('obs', obs), ('gt', rng.normal(size=shape))):
+        paths[name] = tmp_path / f'{name}.nc'
+        xr.Dataset({'ssh': (('time', 'lat', 'lon'), data)}, coords=coords).to_netcdf(paths[name])
+    return paths
+
+
+@pytest.mark.parametrize('use_auto_padding', [False, True])
+@pytest.mark.parametrize('aug_train_data', [False, True])
+def test_sparse_obs_items(tmp_path, use_auto_padding, aug_train_data):
+    paths = write_sources(tmp_path)
+    kwargs = dict(
+        slice_win={'time': 3, 'lat': 4, 'lon': 4}, strides={'time': 1, 'lat': 3, 'lon': 3},
+        dim_range={'time': slice(0, 5), 'lat': slice(40, 50), 'lon': slice(-60, -50)},
+        oi_path=paths['oi'], oi_var='ssh', obs_mask_path=paths['obs'], obs_mask_var='ssh',
+        gt_path=paths['gt'], gt_var='ssh', gt_decode=False, resolution=0.25,
+        use_auto_padding=use_auto_padding, aug_train_data=aug_train_data,
+    )
+    datasets = {}
+    for sparse_obs in (False, True):
+        # same permutations of the augmented observations
+        np.random.seed(0)
+        datasets[sparse_obs] = dataloading.FourDVarNetDataset(sparse_obs=sparse_obs, **kwargs)
+        datasets[sparse_obs].set_norm_stats((0.1, 2.))
+    dense, sparse = datasets[False], datasets[True]
+    assert sparse.obs_mask_ds.data is None and len(sparse.obs_mask_ds.ds.data_vars) == 0
+
+    assert len(sparse) == len(dense)
+    for item in range(len(dense)):
+        oi, mask, obs, gt = dense[item]
+        s_oi, s_obs, s_gt = sparse[item]
+        np.testing.assert_array_equal(s_oi, oi)
+        np.testing.assert_array_equal(s_gt, gt)
+        assert tuple(s_obs.shape) == obs.shape
+        s_mask = np.zeros(obs.size, dtype=bool)
+        s_mask[s_obs.idx] = True
+        s_val = np.zeros(obs.size, dtype=obs.dtype)
+        s_val[s_obs.idx] = s_obs.val
+        np.testing.assert_array_equal(s_mask.reshape(obs.shape), mask)
+        np.testing.assert_allclose(s_val.reshape(obs.shape), obs, rtol=1e-6)
+
+
+def test_sparse_cube_chunks():
+    rng = np.random.default_rng(0)
+    arr = rng.normal(size=(7, 5, 6)).astype(np.float32)
+    arr[rng.random(arr.shape) > 0.2] = np.nan
+    coo = dataloading.SparseCube((arr[t:t + 3] for t in range(0, 7, 3)), arr.shape)
+    idx, val = coo.box((slice(1, 6), slice(1, 4), slice(0, 6)))
+    box = np.full((5, 3, 6), np.nan, dtype=np.float32)
+    box.reshape(-1)[idx] = val
+    np.testing.assert_array_equal(box, arr[1:6, 1:4])
+    with pytest.raises(ValueError):
+        dataloading.SparseCube([arr[:3]], arr.shape)
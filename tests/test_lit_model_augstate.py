@@ -0,0 +1,85 @@
+"""
+CPU checks of the LitModelAugstate inference modes on a small 4dvarnet
+"""
+import numpy as np
+import pytest
+import torch
+import xarray as xr
+
+from lit_model_augstate import LitModelAugstate
+
+DT, N_LAT, N_LON = 5, 16, 16
+
+
+def get_mod(**params):
+    torch.manual_seed(0)
+    hparams = dict(
+        model='4dvarnet', sst=False, aug_state=False, dT=DT, shape_state=[2 * DT, N_LAT, N_LON],
+        n_grad=3, n_fourdvar_iter=1, dW=1, dW2=1, sS=4, nbBlocks=1, DimAE=8, dim_grad_solver=8,
+        dropout=0., dropout_phi_r=0., stochastic=False, UsePriodicBoundary=False, norm_obs='l2', norm_prior='l2',
+        alpha_mse_ssh=1., alpha_mse_gssh=1., alpha_proj=0.5, alpha_sr=0.5, alpha_lr=0.5,
+        mean_Tr=0., mean_Tt=0., mean_Val=0., var_Tr=1., var_Tt=1., var_Val=1.,
+        patch_weight={
+            '_target_': 'lit_model_augstate.get_constant_crop',
+            'patch_size': {'time': DT, 'lat': N_LAT, 'lon': N_LON}, 'crop': {'time': 2, 'lat': 2, 'lon': 2},
+        },
+        **params,
+    )
+    return LitModelAugstate(hparam=hparams).eval()
+
+
+def get_batch(n_batch=2):
+    g = torch.Generator().manual_seed(1)
+    gt = torch.randn(n_batch, DT, N_LAT, N_LON, generator=g)
+    oi = gt + 0.5 * torch.randn(n_batch, DT, N_LAT, N_LON, generator=g)
+    mask = (torch.rand(n_batch, DT, N_LAT, N_LON, generator=g) > 0.7).float()
+    return oi, mask, gt * mask, gt
+
+
+def test_ensemble_members_match_single_runs():
+    n_members = 3
+    mod = get_mod(ensemble_inference=True, size_ensemble=n_members)
+    batch = get_batch()
+    _, ref, _ = mod(batch, phase='test')
+
+    # without noise nor dropout every member of the batched pass is the single run
+    _, members, _ = mod.ensemble_forward(batch, n_members)
+    assert members.shape == (n_members, *ref.shape)
+    for out in members:
+        torch.testing.assert_close(out, ref, atol=1e-5, rtol=1e-4)
+
+
+@pytest.mark.parametrize('params', [dict(dropout=0.25), dict(stochastic=True)])
+def test_ensemble_members_are_independent(params):
+    n_members = 3
+    mod = get_mod(ensemble_inference=True, size_ensemble=n_members, **params)
+    batch = get_batch()
+    _, members, _ = mod.ensemble_forward(batch, n_members)
+    for i in range(1, n_members):
+        assert not torch.allclose(members[i], members[0])
+    # the dropout layers are back in eval mode
+    assert not any(m.training for m in mod.model.modules())
+
+
+class PatchGrid:
+    """
+    Diag dataset stub: two overlapping patches in lat of a (DT, 24, N_LON) grid
+    """
+    def get_patch_index(self):
+        offsets = np.array([[0, 0, 0], [0, 8, 0]])
+        coords = {'time': np.arange(DT), 'lat': np.arange(24.), 'lon': np.arange(float(N_LON))}
+        return offsets, coords
+
+
+def test_build_test_xr_ds_crops_full_patches():
+    mod = get_mod()
+    box = (slice(None),) + mod.get_diag_box()
+    g = torch.Generator().manual_seed(2)
+    full = {k: torch.randn(2, DT, N_LAT, N_LON, generator=g) for k in ('gt', 'pred')}
+    cropped = {k: x[box] for k, x in full.items()}
+
+    ref = mod.build_test_xr_ds([[cropped]], diag_ds=PatchGrid())
+    out = mod.build_test_xr_ds([[full]], diag_ds=PatchGrid())
+    xr.testing.assert_identical(out, ref)
+    # the pixels of a single patch are the patch values
+    np.testing.assert_allclose(out.pred.isel(lat=2, lon=slice(2, -2)).values, full['pred'][0, DT // 2, 2, 2:-2].numpy()[None], rtol=1e-6)
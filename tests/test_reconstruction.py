@@ -0,0 +1,114 @@
+"""
+CPU checks of the patch stitching
+"""
+import socket
+
+import numpy as np
+import pytest
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import xarray as xr
+
+from reconstruction import PatchAccumulator
+
+COORDS = {'time': np.arange(10), 'lat': np.arange(30), 'lon': np.arange(40)}
+
+
+def get_patches(seed=0):
+    rng = np.random.default_rng(seed)
+    weight = rng.random((5, 10, 10))
+    offsets = [(t, la, lo) for t in range(6) for la in range(0, 21, 5) for lo in range(0, 31, 5)]
+    patches = [{'x': rng.normal(size=(5, 10, 10))} for _ in offsets]
+    for p in patches[::7]:
+        p['x'][0, 0, 0] = np.nan
+    return weight, offsets, patches
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def reduce_worker(rank, world_size, port, dst):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank, world_size=world_size)
+    try:
+        weight, offsets, patches = get_patches()
+        acc = PatchAccumulator(COORDS, weight)
+        # the last rank gets no patches and has not allocated the fields
+        n_adding = world_size - 1
+        if rank < n_adding:
+            for o, p in list(zip(offsets, patches))[rank::n_adding]:
+                acc.add(o, p)
+        acc = acc.reduce(dst=dst)
+        if dst is not None and rank != dst:
+            assert acc is None
+            return
+
+        ref = PatchAccumulator(COORDS, weight)
+        for o, p in zip(offsets, patches):
+            ref.add(o, p)
+        xr.testing.assert_allclose(acc.to_xarray(), ref.to_xarray())
+    finally:
+        dist.destroy_process_group()
+
+
+@pytest.mark.parametrize('dst', [0, 1, None])
+def test_reduce(dst):
+    if not dist.is_available():
+        pytest.skip('torch.distributed is not available')
+    world_size = 3
+    mp.spawn(reduce_worker, args=(world_size, free_port(), dst), nprocs=world_size)
+
+
+def stitch_merge(patches, patch_coords, weight):
+    # previous stitching: each patch is broadcast on the union grid of the patches and summed
+    dses = [
+        xr.Dataset({k: (('time', 'lat', 'lon'), x) for k, x in p.items()}, coords=c)
+        for p, c in zip(patches, patch_coords)
+    ]
+    fin_ds = xr.merge([xr.zeros_like(ds[['time', 'lat', 'lon']]) for ds in dses])
+    fin_ds = fin_ds.assign({'weight': (fin_ds.dims, np.zeros(list(fin_ds.dims.values())))})
+    for v in dses[0]:
+        fin_ds = fin_ds.assign({v: (fin_ds.dims, np.zeros(list(fin_ds.dims.values())))})
+
+    for ds in dses:
+        ds_nans = ds.assign(weight=xr.ones_like(ds.gt)).isnull().broadcast_like(fin_ds).fillna(0.)
+        xr_weight = xr.DataArray(weight, ds.coords, dims=ds.gt.dims)
+        _ds = ds.pipe(lambda dds: dds * xr_weight).assign(weight=xr_weight).broadcast_like(fin_ds).fillna(0.).where(ds_nans == 0, np.nan)
+        fin_ds = fin_ds + _ds
+    return (fin_ds.drop('weight') / fin_ds.weight).transpose('time', 'lat', 'lon')
+
+
+def test_accumulator_matches_merge():
+    rng = np.random.default_rng(0)
+    coords = {
+        'time': np.arange('2013-01-01', '2013-01-09', dtype='datetime64[D]').astype('datetime64[ns]'),
+        'lat': 30 + 0.05 * np.arange(12),
+        'lon': -60 + 0.05 * np.arange(14),
+    }
+    # overlapping patches with random positive weights and a zero border
+    weight = np.zeros((4, 6, 6))
+    weight[:, 1:, 1:] = rng.uniform(0.5, 1.5, size=(4, 5, 5))
+    offsets = np.array([(t, la, lo) for t in range(5) for la in (0, 3, 6) for lo in (0, 4, 8)])
+    patches = [{'gt': rng.normal(size=weight.shape), 'pred': rng.normal(size=weight.shape)} for _ in offsets]
+    # the NaNs of the patches are only compared where the weight is positive:
+    # the merge stitching also propagated the NaNs of the zero weight pixels
+    patches[3]['pred'][1, 2, 2] = np.nan
+    patches[10]['gt'][0, 3, 1] = np.nan
+    patch_coords = [
+        {d: coords[d][o:o + n] for d, o, n in zip(('time', 'lat', 'lon'), offset, weight.shape)}
+        for offset in offsets
+    ]
+    ref = stitch_merge(patches, patch_coords, weight)
+
+    acc = PatchAccumulator(coords, weight)
+    acc.add_batch(offsets, {k: np.stack([p[k] for p in patches]) for k in ('gt', 'pred')})
+    xr.testing.assert_allclose(acc.to_xarray(), ref)
+
+    acc = PatchAccumulator(coords, weight, fields=('gt', 'pred'))
+    for o, p in zip(offsets, patches):
+        acc.add(o, p)
+    xr.testing.assert_allclose(acc.to_xarray(), ref)
+    # first lat and lon rows are only covered by zero weights
+    assert acc.to_xarray().gt.isel(lat=0).isnull().all()
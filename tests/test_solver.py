@@ -0,0 +1,221 @@
+"""
+CPU checks of the Solver_Grad_4DVarNN iteration modes against the default unrolled iterations
+"""
+import numpy as np
+import pytest
+import torch
+
+import solver as NN_4DVar
+
+SHAPE = (4, 8, 8)
+
+
+class Phi(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv1 = torch.nn.Conv2d(SHAPE[0], 8, 3, padding=1)
+        self.conv2 = torch.nn.Conv2d(8, SHAPE[0], 3, padding=1)
+
+    def forward(self, x):
+        return self.conv2(torch.tanh(self.conv1(x)))
+
+
+class H(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.dim_obs = 1
+        self.dim_obs_channel = np.array([SHAPE[0]])
+
+    def forward(self, x, y, mask):
+        return (x - y) * mask
+
+
+def get_solver(n_grad=6):
+    torch.manual_seed(0)
+    return NN_4DVar.Solver_Grad_4DVarNN(
+        Phi(), H(), NN_4DVar.model_GradUpdateLSTM(SHAPE, False, 8, 0.), 'l2', 'l2', SHAPE, n_grad,
+    )
+
+
+def get_inputs(n_batch=5):
+    g = torch.Generator().manual_seed(1)
+    obs = torch.randn(n_batch, *SHAPE, generator=g)
+    mask = (torch.rand(n_batch, *SHAPE, generator=g) > 0.5).float()
+    x_0 = (obs * mask).requires_grad_(True)
+    return x_0, obs, mask
+
+
+def solve(solver, x_0, obs, mask):
+    with torch.enable_grad():
+        return solver(x_0, obs, mask)[0]
+
+
+def param_grads(solver, x_0, obs, mask):
+    solver.zero_grad()
+    solve(solver, x_0, obs, mask).square().sum().backward()
+    return [p.grad.clone() for p in solver.parameters() if p.grad is not None]
+
+
+def test_first_order_outputs():
+    solver = get_solver()
+    x_0, obs, mask = get_inputs()
+    ref = solve(solver, x_0, obs, mask)
+
+    solver.first_order = True
+    out = solve(solver, x_0, obs, mask)
+    torch.testing.assert_close(out, ref.detach())
+    # the output only depends on the detached state of the last iteration
+    grads = torch.autograd.grad(out.sum(), list(solver.parameters()), allow_unused=True)
+    assert all(g is None for g in grads)
+
+
+@pytest.mark.parametrize('every', [1, 4, 6])
+def test_checkpoint_gradients(every):
+    solver = get_solver()
+    x_0, obs, mask = get_inputs()
+    ref = param_grads(solver, x_0, obs, mask)
+
+    solver.checkpoint_every = every
+    grads = param_grads(solver, x_0, obs, mask)
+    assert len(grads) == len(ref)
+    for g, r in zip(grads, ref):
+        torch.testing.assert_close(g, r)
+
+
+def test_checkpoint_only_in_training():
+    solver = get_solver().eval()
+    solver.checkpoint_every = 2
+    calls = []
+    solver.solver_steps = lambda *args: calls.append(args)
+    x_0, obs, mask = get_inputs()
+    solve(solver, x_0, obs, mask)
+    assert not calls
+
+
+def first_order_iterates(solver, x_0, obs, mask):
+    """
+    States of the full batch after each first order iteration
+    """
+    x_k, hidden, cell, normgrad = x_0.detach(), None, None, 0.
+    iterates = []
+    with torch.enable_grad():
+        for _ in range(solver.n_grad):
+            x_k, hidden, cell, normgrad = solver.solver_step(x_k.detach().requires_grad_(True), obs, mask, hidden, cell, normgrad)
+            iterates.append(x_k.detach())
+    return iterates
+
+
+def test_adaptive_stopping():
+    solver = get_solver(n_grad=8)
+    solver.first_order = True
+    x_0, obs, mask = get_inputs(n_batch=6)
+    iterates = first_order_iterates(solver, x_0, obs, mask)
+
+    # expected iteration count of each patch from the full batch iterates
+    prev = [x_0.detach()] + iterates[:-1]
+    changes = torch.stack([
+        (x - p).flatten(1).norm(dim=1) / p.flatten(1).norm(dim=1) for x, p in zip(iterates, prev)
+    ])
+    # halfway between two changes so that no patch is at the tolerance
+    mid = changes[len(iterates) // 2].sort().values
+    tol = float(mid[2] + mid[3]) / 2
+    below = changes < tol
+    n_iters = torch.where(below.any(0), below.float().argmax(0) + 1, torch.tensor(solver.n_grad))
+
+    solver.stop_tol = tol
+    out = solve(solver, x_0, obs, mask)
+    assert solver.iter_counts.sum() == len(n_iters)
+    np.testing.assert_array_equal(solver.iter_counts, np.bincount(n_iters.numpy(), minlength=solver.n_grad + 1))
+    for i, n in enumerate(n_iters):
+        torch.testing.assert_close(out[i], iterates[n - 1][i])
+
+
+def test_adaptive_stopping_without_tolerance():
+    solver = get_solver()
+    solver.first_order = True
+    x_0, obs, mask = get_inputs()
+    ref = solve(solver, x_0, obs, mask)
+
+    solver.stop_tol = 0.
+    out = solve(solver, x_0, obs, mask)
+    assert solver.iter_counts[solver.n_grad] == len(x_0)
+    torch.testing.assert_close(out, ref.detach())
+
+
+def test_phantom_gradients():
+    solver = get_solver()
+    x_0, obs, mask = get_inputs()
+    ref = param_grads(solver, x_0, obs, mask)
+
+    # phantom gradient through all the iterations is the unrolled gradient
+    solver.grad_mode, solver.grad_steps = 'phantom', solver.n_grad
+    for g, r in zip(param_grads(solver, x_0, obs, mask), ref):
+        torch.testing.assert_close(g, r)
+
+    # a single Neumann term is the phantom gradient of the last iteration
+    solver.grad_steps = 1
+    phantom = param_grads(solver, x_0, obs, mask)
+    solver.grad_mode = 'implicit'
+    for g, r in zip(param_grads(solver, x_0, obs, mask), phantom):
+        torch.testing.assert_close(g, r)
+
+    solver.grad_steps = 3
+    assert all(torch.isfinite(g).all() for g in param_grads(solver, x_0, obs, mask))
+
+
+class Contraction(torch.nn.Module):
+    """
+    x -> tanh(x W + b) with ||W||_2 = 1/2: a contraction whose Jacobian is computed exactly
+    """
+    def __init__(self, dim):
+        super().__init__()
+        g = torch.Generator().manual_seed(2)
+        w = torch.randn(dim, dim, generator=g, dtype=torch.float64)
+        self.w = torch.nn.Parameter(0.5 * w / torch.linalg.matrix_norm(w, ord=2))
+        self.b = torch.nn.Parameter(torch.randn(dim, generator=g, dtype=torch.float64))
+
+    def forward(self, x):
+        return torch.tanh(x.flatten(1) @ self.w + self.b).view_as(x)
+
+
+@pytest.mark.parametrize('grad_steps', [2, 5, 80])
+def test_implicit_gradients(grad_steps):
+    solver = get_solver(n_grad=20)
+    # the state update is replaced by a contraction of the state
+    f = Contraction(int(np.prod(SHAPE)))
+    solver.solver_step = lambda x_k, obs, mask, hidden, cell, normgrad=0., grad_scale=1.: (f(x_k), hidden, cell, normgrad)
+    solver.grad_mode, solver.grad_steps = 'implicit', grad_steps
+    x_0, obs, mask = [t[:1].double() for t in get_inputs()]
+    solve(solver, x_0, obs, mask).square().sum().backward()
+
+    # state entering the last iteration and Jacobian of the map there
+    x_star = x_0.detach()
+    with torch.no_grad():
+        for _ in range(solver.n_grad - 1):
+            x_star = f(x_star)
+    jac = torch.autograd.functional.jacobian(lambda x: f(x.view_as(x_star)).flatten(), x_star.flatten())
+    x_out = f(x_star)
+    grad = 2 * x_out.detach().flatten()
+
+    # truncated Neumann series of (I - J^T)^-1 applied to the output gradient
+    term, neumann = grad, grad
+    for _ in range(grad_steps - 1):
+        term = jac.T @ term
+        neumann = neumann + term
+    if grad_steps == 80:
+        # converged to the exact implicit gradient: ||J|| <= 1/2
+        exact = torch.linalg.solve(torch.eye(len(grad), dtype=grad.dtype) - jac.T, grad)
+        torch.testing.assert_close(neumann, exact)
+    expected = torch.autograd.grad(x_out, [f.w, f.b], neumann.view_as(x_out))
+    torch.testing.assert_close(f.w.grad, expected[0])
+    torch.testing.assert_close(f.b.grad, expected[1])
+
+
+def test_fixed_point_only_in_training():
+    solver = get_solver().eval()
+    solver.grad_mode = 'implicit'
+    calls = []
+    solver.solve_fixed_point = lambda *args: calls.append(args)
+    x_0, obs, mask = get_inputs()
+    solve(solver, x_0, obs, mask)
+    assert not calls